@@ -18,12 +18,21 @@ def run_mt_bench_op(
     models_folder: str,
     output_path: str = "/output/mt_bench_data.json",
     judge_secret_name: str = None,
+    http_pool_size: int = 64,
+    http_keepalive_expiry: float = 60.0,
+    http2: bool = False,
+    http_connect_timeout: float = 10.0,
+    http_read_timeout: float = 600.0,
 ) -> NamedTuple("outputs", best_model=str, best_score=float):
     import base64
+    import collections
     import json
     import os
+    import re
     import ssl
     import subprocess
+    import threading
+    import time
 
     import httpx
     import requests
@@ -68,8 +77,208 @@ def run_mt_bench_op(
                 f"Error fetching secret: {response.status_code} {response.text}"
             )
 
-    # Use the default SSL context since it leverages OpenSSL to use the correct CA bundle.
-    judge_http_client = httpx.Client(verify=ssl.create_default_context())
+    class EndpointRouterTransport(httpx.BaseTransport):
+        """Spreads the requests to a model server over its replicas.
+
+        Requests to the first endpoint are sent to the replica with the fewest outstanding requests, then the
+        lowest recent latency. A replica failing max_failures requests in a row, with connection errors or 5xx
+        responses, is ejected for eject_seconds. Requests to other servers are passed through.
+        """
+
+        def __init__(self, transport, endpoints, max_failures=3, eject_seconds=30.0):
+            self._transport = transport
+            self._endpoints = endpoints
+            self._max_failures = max_failures
+            self._eject_seconds = eject_seconds
+            self._lock = threading.Lock()
+            self.replicas = {
+                endpoint: {
+                    "outstanding": 0,
+                    "latency": 0.0,
+                    "failures": 0,
+                    "ejected_until": 0.0,
+                    "requests": 0,
+                    "ejections": 0,
+                }
+                for endpoint in endpoints
+            }
+            # Requests are matched on the parsed URLs, which httpx normalizes the same way as the request URLs
+            self._urls = {
+                endpoint: httpx.URL(endpoint.rstrip("/")) for endpoint in endpoints
+            }
+
+        def _pick(self, exclude=()):
+            now = time.monotonic()
+            candidates = [
+                endpoint
+                for endpoint, replica in self.replicas.items()
+                if replica["ejected_until"] <= now and endpoint not in exclude
+            ]
+            if not candidates:
+                # Without a healthy replica, try the one that is back the soonest
+                return min(
+                    self.replicas,
+                    key=lambda endpoint: self.replicas[endpoint]["ejected_until"],
+                )
+            return min(
+                candidates,
+                key=lambda endpoint: (
+                    self.replicas[endpoint]["outstanding"],
+                    self.replicas[endpoint]["latency"],
+                ),
+            )
+
+        def _record(self, endpoint, start, failed):
+            with self._lock:
+                replica = self.replicas[endpoint]
+                replica["outstanding"] -= 1
+                if not failed:
+                    replica["failures"] = 0
+                    # Exponentially weighted moving average of the response latency
+                    latency = time.monotonic() - start
+                    replica["latency"] = (
+                        latency
+                        if not replica["latency"]
+                        else 0.8 * replica["latency"] + 0.2 * latency
+                    )
+                    return
+                replica["failures"] += 1
+                if replica["failures"] >= self._max_failures:
+                    replica["failures"] = 0
+                    replica["ejected_until"] = time.monotonic() + self._eject_seconds
+                    replica["ejections"] += 1
+                    print(
+                        f"Ejecting {endpoint} for {self._eject_seconds}s after {self._max_failures} failures"
+                    )
+
+        def _relative_path(self, url):
+            """Returns the path of url below the first endpoint, or None when url isn't for the model server."""
+            base_url = self._urls[self._endpoints[0]]
+            if (url.scheme, url.host, url.port) != (
+                base_url.scheme,
+                base_url.host,
+                base_url.port,
+            ):
+                return None
+            base_path = base_url.path.rstrip("/")
+            if url.path != base_path and not url.path.startswith(f"{base_path}/"):
+                return None
+            return url.path[len(base_path) :]
+
+        def handle_request(self, request):
+            relative_path = (
+                self._relative_path(request.url) if len(self._endpoints) > 1 else None
+            )
+            if relative_path is None:
+                return self._transport.handle_request(request)
+
+            headers = request.headers.copy()
+            del headers["host"]
+            tried = set(request.extensions.get("exclude_endpoints", ()))
+            while True:
+                with self._lock:
+                    endpoint = self._pick(tried)
+                    self.replicas[endpoint]["outstanding"] += 1
+                    self.replicas[endpoint]["requests"] += 1
+                tried.add(endpoint)
+                request.extensions["endpoint"] = endpoint
+                routed_request = httpx.Request(
+                    request.method,
+                    request.url.copy_with(
+                        scheme=self._urls[endpoint].scheme,
+                        host=self._urls[endpoint].host,
+                        port=self._urls[endpoint].port,
+                        path=self._urls[endpoint].path.rstrip("/") + relative_path,
+                    ),
+                    headers=headers,
+                    content=request.content,
+                    extensions=request.extensions,
+                )
+
+                start = time.monotonic()
+                try:
+                    response = self._transport.handle_request(routed_request)
+                except httpx.ConnectError:
+                    self._record(endpoint, start, failed=True)
+                    # The request was not sent, so it can go to another replica
+                    if len(tried) < len(self._endpoints):
+                        continue
+                    raise
+                except httpx.TransportError:
+                    self._record(endpoint, start, failed=True)
+                    raise
+                self._record(endpoint, start, failed=response.status_code >= 500)
+                return response
+
+        def print_stats(self):
+            if len(self._endpoints) < 2:
+                return
+            for endpoint, replica in self.replicas.items():
+                print(
+                    f"{endpoint}: {replica['requests']} requests routed, {replica['ejections']} ejections"
+                )
+
+        def close(self):
+            self._transport.close()
+
+    class PooledTransport(httpx.BaseTransport):
+        """An httpx transport with a keep-alive connection pool sized for concurrent requests.
+
+        The default httpx pool only keeps 20 idle connections, so at higher concurrency connections are closed
+        and reopened with a new TLS handshake. Requests, new connections, TLS handshakes and errors are counted
+        per endpoint.
+        """
+
+        def __init__(self, pool_size, keepalive_expiry, http2):
+            if http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    print("HTTP/2 requires the h2 package, falling back to HTTP/1.1")
+                    http2 = False
+            # Use the default SSL context since it leverages OpenSSL to use the correct CA bundle.
+            self._transport = httpx.HTTPTransport(
+                verify=ssl.create_default_context(),
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+            )
+            self._lock = threading.Lock()
+            self.stats = collections.defaultdict(collections.Counter)
+
+        def handle_request(self, request):
+            stats = self.stats[f"{request.url.scheme}://{request.url.netloc.decode()}"]
+
+            def trace(event_name, info):
+                if event_name == "connection.connect_tcp.complete":
+                    with self._lock:
+                        stats["connections"] += 1
+                elif event_name == "connection.start_tls.complete":
+                    with self._lock:
+                        stats["tls_handshakes"] += 1
+
+            request.extensions["trace"] = trace
+            with self._lock:
+                stats["requests"] += 1
+            try:
+                return self._transport.handle_request(request)
+            except httpx.TransportError:
+                with self._lock:
+                    stats["errors"] += 1
+                raise
+
+        def print_stats(self):
+            for endpoint, stats in sorted(self.stats.items()):
+                print(
+                    f"{endpoint}: {stats['requests']} requests, {stats['connections']} new connections, "
+                    f"{stats['tls_handshakes']} TLS handshakes, {stats['errors']} connection errors"
+                )
+
+        def close(self):
+            self._transport.close()
 
     if judge_secret_name is None:
         judge_api_key = os.getenv("JUDGE_API_KEY", "")
@@ -82,6 +291,18 @@ def run_mt_bench_op(
         )
         print("Eval Judge secret data retrieved.")
 
+    # The endpoint can list the replicas of the judge model server, separated by commas or whitespace
+    judge_endpoints = [e.rstrip("/") for e in re.split(r"[,\s]+", judge_endpoint) if e]
+    judge_endpoint = judge_endpoints[0]
+
+    # The client is shared by the requests to the served candidate model and to the judge model
+    judge_transport = PooledTransport(http_pool_size, http_keepalive_expiry, http2)
+    judge_router = EndpointRouterTransport(judge_transport, judge_endpoints)
+    judge_http_client = httpx.Client(
+        transport=judge_router,
+        timeout=httpx.Timeout(http_read_timeout, connect=http_connect_timeout),
+    )
+
     def launch_vllm(
         model_path: str, gpu_count: int, retries: int = 120, delay: int = 10
     ) -> tuple:
@@ -234,6 +455,9 @@ def run_mt_bench_op(
         all_mt_bench_data.append(mt_bench_data)
         scores[model_path] = overall_score
 
+    judge_router.print_stats()
+    judge_transport.print_stats()
+
     outputs = NamedTuple("outputs", best_model=str, best_score=float)
     best_model = max(scores, key=scores.get)
     best_score = scores[best_model]
@@ -17,7 +17,11 @@ from kfp.kubernetes import (
 
 from eval import generate_metrics_report_op, run_final_eval_op, run_mt_bench_op
 from sdg import (
+    sdg_dedup_op,
+    sdg_estimate_op,
     sdg_op,
+    sdg_shard_check_op,
+    sdg_shard_plan_op,
     sdg_to_artifact_op,
     taxonomy_to_artifact_op,
 )
@@ -28,6 +32,7 @@ from training import (
     skills_processed_data_to_artifact_op,
 )
 from utils import (
+    create_cache_pvc_op,
     ilab_importer_op,
     model_to_pvc_op,
     pvc_to_mmlu_branch_op,
@@ -35,7 +40,7 @@ from utils import (
     pvc_to_mt_bench_op,
     upload_model_op,
 )
-from utils.components import prerequisites_check_op
+from utils.components import prerequisites_check_op, test_model_connection
 from utils.consts import (
     RHELAI_IMAGE,
     RUNTIME_GENERIC_IMAGE,
@@ -68,6 +73,7 @@ def ilab_pipeline(
     sdg_repo_pr: Optional[
         int
     ] = 0,  # FIXME: https://issues.redhat.com/browse/RHOAIRFE-467
+    sdg_repo_sparse_checkout: bool = False,
     sdg_teacher_secret: str = "teacher-secret",
     sdg_scale_factor: int = 30,  # https://github.com/instructlab/instructlab/blob/v0.21.2/tests/testdata/default_config.yaml#L125
     sdg_pipeline: str = "/usr/share/instructlab/sdg/pipelines/agentic",  # https://github.com/instructlab/instructlab/blob/v0.21.2/tests/testdata/default_config.yaml#L122
@@ -75,6 +81,23 @@ def ilab_pipeline(
     sdg_sample_size: float = 1.0,  # FIXME: Not present in default config. Not configurable upstream at this point, capability added via https://github.com/instructlab/sdg/pull/432
     sdg_batch_size: int = 32,
     sdg_num_workers: int = 2,
+    sdg_num_shards: int = 1,
+    sdg_adaptive_concurrency: bool = False,
+    sdg_teacher_tokens_per_second: float = 1000.0,
+    sdg_max_teacher_hours: float = 0.0,
+    sdg_incremental: bool = False,
+    sdg_incremental_cache_size_gb: int = 20,
+    sdg_teacher_cache_size_gb: int = 0,
+    sdg_document_cache_size_gb: int = 0,
+    sdg_chunk_max_tokens: int = 0,
+    sdg_probe_teacher: bool = False,
+    sdg_dedup_threshold: float = 0.0,
+    sdg_hedge_requests: bool = False,
+    sdg_prefix_ordering: bool = True,
+    sdg_leaf_timeout_minutes: float = 0.0,
+    sdg_leaf_max_failures: int = 0,
+    sdg_tokenized_cache_size_gb: int = 0,
+    sdg_token_arrays: bool = False,
     # Training phase
     train_tolerations: Optional[list] = None,
     train_node_selectors: Optional[dict] = None,
@@ -108,6 +131,7 @@ def ilab_pipeline(
     # Other options
     k8s_storage_class_name: str = "standard",  # FIXME: https://github.com/kubeflow/pipelines/issues/11396, https://issues.redhat.com/browse/RHOAIRFE-470
     k8s_storage_size: str = "100Gi",
+    k8s_cache_pvc_name: str = "instructlab-cache",
 ):
     """InstructLab pipeline
 
@@ -124,6 +148,7 @@ def ilab_pipeline(
         sdg_repo_secret: SDG parameter. The name of the k8s secret holding access credentials to the sdg_repo_url.
         sdg_repo_branch: SDG parameter. Points to a branch within the taxonomy git repository. If set, has priority over sdg_repo_pr
         sdg_repo_pr: SDG parameter. Points to a pull request against the taxonomy git repository
+        sdg_repo_sparse_checkout: SDG parameter. If set along with sdg_repo_branch or sdg_repo_pr, the taxonomy git repository is partially cloned and only the leaf nodes changed compared to the default branch are checked out and used for data generation.
         sdg_teacher_secret: SDG parameter. The name of the k8s secret key holding access credentials to the teacher server.
         sdg_base_model: SDG parameter. The LLM model used to generate the synthetic dataset. This can be a model from OCI such as "oci://registry.redhat.io/rhelai1/modelcar-granite-8b-code-instruct:latest" or "s3://<BUCKET>/<PATH_TO_MODEL>".
         sdg_scale_factor: SDG parameter. The total number of instructions to be generated.
@@ -132,6 +157,23 @@ def ilab_pipeline(
         sdg_sample_size: SDG parameter. Represents the sdg skills recipe sampling size as percentage in decimal form.
         sdg_batch_size: SDG parameter. The number of completions per request to the teacher model. Must be a value between 1-4096. This can be increased to improve SDG performance based on the hardware of the teacher model or reduced if SDG fails due to connection errors with the teacher model.
         sdg_num_workers: SDG parameter. The number of concurrent workers sending completion requests to the teacher model. Must be a value between 2-10. This can be increased to improve SDG performance based on the hardware of the teacher model or reduced if SDG fails due to connection errors with the teacher model.
+        sdg_num_shards: SDG parameter. If greater than 1, the taxonomy leaf nodes are partitioned into this many shards balanced by their number of samples, and the synthetic data of each shard is generated by a separate pod in parallel before being merged. The shard pods don't request an accelerator. This increases SDG throughput when the teacher model has capacity for more than sdg_num_workers concurrent requests.
+        sdg_adaptive_concurrency: SDG parameter. If set, sdg_num_workers and sdg_batch_size are only the starting point. The number of concurrent requests to the teacher model is adjusted at runtime, increasing while responses stay fast and halving on 429 or 5xx responses, connection errors or when the latency per generated token grows too much. The batch size is adjusted between taxonomy leaf nodes once the concurrency can't change further. The chosen values are logged.
+        sdg_teacher_tokens_per_second: SDG parameter. The expected completion tokens per second of the teacher model, used to estimate the SDG duration before any teacher requests are sent.
+        sdg_max_teacher_hours: SDG parameter. If greater than 0, the pipeline fails before SDG sends any teacher requests when the estimated teacher time exceeds this number of hours. With 0, the estimate is only logged and a failure to estimate does not fail the pipeline.
+        sdg_incremental: SDG parameter. If set, the synthetic data of each taxonomy leaf node is stored in the k8s_cache_pvc_name volume, keyed by a hash of its seed examples, documents, the SDG pipeline and the teacher model. Later runs reuse it and only call the teacher model for new or changed leaf nodes.
+        sdg_incremental_cache_size_gb: SDG parameter. The size in GB the synthetic data of the leaf nodes cached by sdg_incremental is bounded to, least recently used leaf nodes are evicted first.
+        sdg_teacher_cache_size_gb: SDG parameter. If greater than 0, teacher model responses are cached on the SDG volume, up to this size in GB with least recently used entries evicted first. A retried SDG task then replays the responses it already received instead of calling the teacher model again.
+        sdg_document_cache_size_gb: SDG parameter. If greater than 0, the docling conversions of knowledge documents are cached in the k8s_cache_pvc_name volume, keyed by the document repository, commit and file contents, up to this size in GB with least recently used entries evicted first. Later runs only convert new or changed documents.
+        sdg_chunk_max_tokens: SDG parameter. Knowledge documents are chunked into chunks of 500 tokens of the teacher tokenizer, same as instructlab-sdg. With sdg_probe_teacher, the chunks fill the probed context window of the teacher model besides the prompt and the completion. If greater than 0, the chunks hold up to this many tokens, and no more than fit the probed context window.
+        sdg_probe_teacher: SDG parameter. If set, the teacher model server is probed before SDG for its context window and the SDG prompt template matching the served model, and a short benchmark replaces sdg_batch_size and sdg_num_workers with the values giving the most throughput. The chosen values are logged.
+        sdg_dedup_threshold: SDG parameter. If greater than 0, exact and near duplicate samples are removed from the generated skills and knowledge datasets before training. Samples are near duplicates when the Jaccard similarity of their normalized message text is above about this threshold, estimated with MinHash and locality-sensitive hashing in bounded memory. The number of removed samples is logged.
+        sdg_hedge_requests: SDG parameter. If set, a teacher request taking longer than 95% of the recent requests of the same size is sent again, to another replica of the teacher model server if there are several, and the first response is used. At most 5% of the requests are duplicated. The hedge rate and the latency saved are logged.
+        sdg_prefix_ordering: SDG parameter. If set, the prompts of batched teacher requests are sorted so that prompts sharing a prefix are sent together and are more likely to hit the prefix cache of the teacher model server. The share of prompt characters a modelled prefix cache could reuse is reported as the modelled_prefix_sharing_ratio metric, it isn't measured by the server.
+        sdg_leaf_timeout_minutes: SDG parameter. If greater than 0, the teacher requests of a taxonomy leaf node must complete within this many minutes, otherwise the leaf node is quarantined and SDG goes on with the remaining leaf nodes.
+        sdg_leaf_max_failures: SDG parameter. If greater than 0, a taxonomy leaf node is quarantined after this many consecutive failed teacher requests and SDG goes on with the remaining leaf nodes. The quarantined leaf nodes are recorded in the SDG journal, skipped on retries, listed in the SDG metrics report and left out of the generated datasets.
+        sdg_tokenized_cache_size_gb: Training parameter. If greater than 0, the tokenized training samples are cached in the k8s_cache_pvc_name volume, keyed by their messages, the tokenizer of the base model and the chat template, up to this size in GB with least recently used entries evicted first. The data processing of later runs only tokenizes new or changed samples.
+        sdg_token_arrays: Training parameter. If set, the processed skills and knowledge datasets are also written as flat int32 token arrays (input_ids.bin and labels.bin) with an index of the offset and length of each sample (index.npy), which data loaders can memory-map with NumPy instead of parsing data.jsonl. The layout is described in token_arrays.json next to data.jsonl.
 
         train_tolerations: Training parameter. List of tolerations applied to training and eval pods.
         train_node_selectors: Training parameter. A JSON containing node selectors applied to training pods.
@@ -149,7 +191,7 @@ def ilab_pipeline(
         train_num_warmup_steps_phase_1: Training parameter for in Phase 1. The number of steps a model should go through before reaching the full learning rate. We start at 0 and linearly climb up to train_learning_rate.
         train_num_warmup_steps_phase_2: Training parameter for in Phase 2. The number of steps a model should go through before reaching the full learning rate. We start at 0 and linearly climb up to train_learning_rate.
         train_save_samples: Training parameter. Number of samples the model should see before saving a checkpoint.
-        train_max_batch_len: Training parameter. Maximum tokens per gpu for each batch that will be handled in a single step.
+        train_max_batch_len: Training parameter. Maximum tokens per gpu for each batch that will be handled in a single step. The data processing packs the samples into batches of this size for each GPU with first-fit-decreasing, saves the plan as packing_plan.json next to data.jsonl and logs the packing efficiency.
         train_seed: Training parameter. Random seed for initializing training.
 
         mt_bench_max_workers: MT Bench parameter. Number of workers to use for evaluation with mt_bench or mt_bench_branch. Must be a positive integer or 'auto'.
@@ -165,6 +207,7 @@ def ilab_pipeline(
 
         k8s_storage_class_name: A Kubernetes StorageClass name for persistent volumes. Selected StorageClass must support ReadWriteMany(RWX) PersistentVolume access mode.
         k8s_storage_size: The storage size of the persistent volume used for data passing within the pipeline.
+        k8s_cache_pvc_name: The name of the persistent volume claim that caches data (e.g. the git mirrors of the taxonomy and of the knowledge document repositories) across pipeline runs. It is created with k8s_storage_class_name and k8s_storage_size if it does not exist and is never deleted by the pipeline.
     """
     # Pre-requisites check stage
     prerequisites_check_task = prerequisites_check_op(
@@ -180,6 +223,15 @@ def ilab_pipeline(
         output_model_version=output_model_version,
     )
 
+    # Cache shared across pipeline runs
+    cache_pvc_task = create_cache_pvc_op(
+        pvc_name=k8s_cache_pvc_name,
+        storage_class_name=k8s_storage_class_name,
+        size=k8s_storage_size,
+    )
+    cache_pvc_task.set_caching_options(False)
+    cache_pvc_task.after(prerequisites_check_task)
+
     # SDG stage
     sdg_input_pvc_task = CreatePVC(
         pvc_name_suffix="-sdg",
@@ -194,45 +246,178 @@ def ilab_pipeline(
     )
     model_tokenizer_source_task.after(prerequisites_check_task)
 
-    sdg_task = sdg_op(
+    # Size SDG for the teacher model server, or pass the configured values through
+    sdg_probe_task = test_model_connection(
+        secret_name=sdg_teacher_secret,
+        probe=sdg_probe_teacher,
+        batch_size=sdg_batch_size,
+        num_workers=sdg_num_workers,
+    )
+    sdg_probe_task.set_caching_options(False)
+    sdg_probe_task.after(prerequisites_check_task)
+
+    sdg_args = dict(
         num_instructions_to_generate=sdg_scale_factor,
         pipeline=sdg_pipeline,
         repo_branch=sdg_repo_branch,
         repo_pr=sdg_repo_pr,
+        sparse_checkout=sdg_repo_sparse_checkout,
         sdg_sampling_size=sdg_sample_size,
         sdg_secret_name=sdg_teacher_secret,
-        sdg_batch_size=sdg_batch_size,
-        sdg_num_cpus=sdg_num_workers,
+        sdg_batch_size=sdg_probe_task.outputs["batch_size"],
+        sdg_num_cpus=sdg_probe_task.outputs["num_workers"],
         repo_url=sdg_repo_url,
         taxonomy_repo_secret=sdg_repo_secret,
         tokenizer_model=model_tokenizer_source_task.output,
+        cache_path="/cache",
+        incremental=sdg_incremental,
+        incremental_cache_size_gb=sdg_incremental_cache_size_gb,
+        teacher_cache_size_gb=sdg_teacher_cache_size_gb,
+        document_cache_size_gb=sdg_document_cache_size_gb,
+        chunk_max_tokens=sdg_chunk_max_tokens,
+        server_ctx_size=sdg_probe_task.outputs["server_ctx_size"],
+        model_family=sdg_probe_task.outputs["model_family"],
+        adaptive_concurrency=sdg_adaptive_concurrency,
+        hedge_requests=sdg_hedge_requests,
+        prefix_ordering=sdg_prefix_ordering,
+        leaf_timeout_minutes=sdg_leaf_timeout_minutes,
+        leaf_max_failures=sdg_leaf_max_failures,
+    )
+
+    # Preprocess the taxonomy once, generate the leaf nodes of each shard in parallel and merge the results
+    sdg_preprocess_task = sdg_op(**sdg_args, stage="preprocess")
+    sdg_preprocess_task.set_caching_options(False)
+    sdg_preprocess_task.set_env_variable("HOME", "/tmp")
+    sdg_preprocess_task.set_env_variable("HF_HOME", "/tmp")
+    sdg_preprocess_task.set_accelerator_type(eval_gpu_identifier)
+    sdg_preprocess_task.set_accelerator_limit(1)
+    add_toleration_json(sdg_preprocess_task, train_tolerations)
+    add_node_selector_json(sdg_preprocess_task, train_node_selectors)
+    mount_pvc(
+        task=sdg_preprocess_task,
+        pvc_name=sdg_input_pvc_task.output,
+        mount_path="/data",
+    )
+    mount_pvc(
+        task=sdg_preprocess_task,
+        pvc_name=cache_pvc_task.output,
+        mount_path="/cache",
     )
-    sdg_task.set_caching_options(False)
-    sdg_task.set_env_variable("HOME", "/tmp")
-    sdg_task.set_env_variable("HF_HOME", "/tmp")
-    sdg_task.set_accelerator_type(eval_gpu_identifier)
-    sdg_task.set_accelerator_limit(1)
-    add_toleration_json(sdg_task, train_tolerations)
-    add_node_selector_json(sdg_task, train_node_selectors)
+    sdg_preprocess_task.after(prerequisites_check_task)
 
+    # Estimate the teacher work and enforce the budget before any teacher requests are sent
+    sdg_estimate_task = sdg_estimate_op(
+        num_instructions_to_generate=sdg_scale_factor,
+        pipeline=sdg_pipeline,
+        tokenizer_model=model_tokenizer_source_task.output,
+        teacher_tokens_per_second=sdg_teacher_tokens_per_second,
+        max_teacher_hours=sdg_max_teacher_hours,
+        sdg_batch_size=sdg_probe_task.outputs["batch_size"],
+    )
+    sdg_estimate_task.set_caching_options(False)
+    sdg_estimate_task.set_env_variable("HOME", "/tmp")
+    sdg_estimate_task.set_env_variable("HF_HOME", "/tmp")
     mount_pvc(
-        task=sdg_task,
+        task=sdg_estimate_task,
         pvc_name=sdg_input_pvc_task.output,
         mount_path="/data",
     )
-    sdg_task.set_caching_options(False)
-    sdg_task.after(prerequisites_check_task)
+    sdg_estimate_task.after(sdg_preprocess_task)
+
+    with dsl.If(sdg_num_shards == 1):
+        # Without sharding, a single task generates the leaf nodes and merges them
+        sdg_task = sdg_op(**sdg_args, stage="merge")
+        sdg_task.set_caching_options(False)
+        sdg_task.set_env_variable("HOME", "/tmp")
+        sdg_task.set_env_variable("HF_HOME", "/tmp")
+        mount_pvc(
+            task=sdg_task,
+            pvc_name=sdg_input_pvc_task.output,
+            mount_path="/data",
+        )
+        mount_pvc(
+            task=sdg_task,
+            pvc_name=cache_pvc_task.output,
+            mount_path="/cache",
+        )
+        sdg_task.after(sdg_estimate_task)
+
+    with dsl.Else():
+        sdg_shard_plan_task = sdg_shard_plan_op(num_shards=sdg_num_shards)
+        sdg_shard_plan_task.set_caching_options(False)
+        mount_pvc(
+            task=sdg_shard_plan_task,
+            pvc_name=sdg_input_pvc_task.output,
+            mount_path="/data",
+        )
+        sdg_shard_plan_task.after(sdg_estimate_task)
+
+        # The shards only send requests to the teacher model and don't need an accelerator
+        with dsl.ParallelFor(sdg_shard_plan_task.output) as shard_index:
+            sdg_shard_task = sdg_op(
+                **sdg_args, stage="generate", shard_index=shard_index
+            )
+            sdg_shard_task.set_caching_options(False)
+            sdg_shard_task.set_env_variable("HOME", "/tmp")
+            sdg_shard_task.set_env_variable("HF_HOME", "/tmp")
+            mount_pvc(
+                task=sdg_shard_task,
+                pvc_name=sdg_input_pvc_task.output,
+                mount_path="/data",
+            )
+            mount_pvc(
+                task=sdg_shard_task,
+                pvc_name=cache_pvc_task.output,
+                mount_path="/cache",
+            )
+
+        # Tasks after a dsl.ParallelFor can't have pipeline parameter inputs, so the merge waits on this check instead
+        sdg_shard_check_task = sdg_shard_check_op()
+        sdg_shard_check_task.set_caching_options(False)
+        mount_pvc(
+            task=sdg_shard_check_task,
+            pvc_name=sdg_input_pvc_task.output,
+            mount_path="/data",
+        )
+        sdg_shard_check_task.after(sdg_shard_task)
+
+        sdg_sharded_task = sdg_op(**sdg_args, stage="merge")
+        sdg_sharded_task.set_caching_options(False)
+        sdg_sharded_task.set_env_variable("HOME", "/tmp")
+        sdg_sharded_task.set_env_variable("HF_HOME", "/tmp")
+        mount_pvc(
+            task=sdg_sharded_task,
+            pvc_name=sdg_input_pvc_task.output,
+            mount_path="/data",
+        )
+        mount_pvc(
+            task=sdg_sharded_task,
+            pvc_name=cache_pvc_task.output,
+            mount_path="/cache",
+        )
+        sdg_sharded_task.after(sdg_shard_check_task)
+
+    # Drop duplicate samples before they are uploaded and processed for training
+    sdg_dedup_task = sdg_dedup_op(threshold=sdg_dedup_threshold)
+    sdg_dedup_task.set_caching_options(False)
+    mount_pvc(
+        task=sdg_dedup_task,
+        pvc_name=sdg_input_pvc_task.output,
+        mount_path="/data",
+    )
+    # Waits on whichever of the two branches ran
+    sdg_dedup_task.after(sdg_task, sdg_sharded_task)
 
     # Upload "sdg" and "taxonomy" artifacts to S3 without blocking the rest of the workflow
     taxonomy_to_artifact_task = taxonomy_to_artifact_op()
-    taxonomy_to_artifact_task.after(sdg_task)
+    taxonomy_to_artifact_task.after(sdg_task, sdg_sharded_task)
     mount_pvc(
         task=taxonomy_to_artifact_task,
         pvc_name=sdg_input_pvc_task.output,
         mount_path="/data",
     )
     sdg_to_artifact_task = sdg_to_artifact_op()
-    sdg_to_artifact_task.after(sdg_task)
+    sdg_to_artifact_task.after(sdg_dedup_task)
     mount_pvc(
         task=sdg_to_artifact_task,
         pvc_name=sdg_input_pvc_task.output,
@@ -263,18 +448,31 @@ def ilab_pipeline(
     )
 
     # Data processing
-    data_processing_task = data_processing_op(max_batch_len=sdg_max_batch_len)
+    data_processing_task = data_processing_op(
+        max_batch_len=sdg_max_batch_len,
+        cache_path="/cache",
+        tokenized_cache_size_gb=sdg_tokenized_cache_size_gb,
+        token_arrays=sdg_token_arrays,
+        packing_max_batch_len=train_max_batch_len,
+        nproc_per_node=train_gpu_per_worker,
+        nnodes=train_num_workers,
+    )
     mount_pvc(
         task=data_processing_task,
         pvc_name=model_pvc_task.output,
         mount_path="/model",
     )
+    mount_pvc(
+        task=data_processing_task,
+        pvc_name=cache_pvc_task.output,
+        mount_path="/cache",
+    )
     mount_pvc(
         task=data_processing_task,
         pvc_name=sdg_input_pvc_task.output,
         mount_path="/data",
     )
-    data_processing_task.after(model_to_pvc_task, sdg_task)
+    data_processing_task.after(model_to_pvc_task, sdg_dedup_task)
     data_processing_task.set_caching_options(False)
     data_processing_task.set_env_variable("XDG_CACHE_HOME", "/tmp")
     data_processing_task.set_accelerator_type(eval_gpu_identifier)
@@ -624,5 +822,103 @@ def run(experiment, run_name, param):
     )
 
 
+@cli.command(name="estimate")
+@click.argument("taxonomy_path", type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "--taxonomy-base",
+    default="empty",
+    show_default=True,
+    help="Git ref to diff the taxonomy against, 'empty' uses every leaf node.",
+)
+@click.option("--pipeline", default="simple", show_default=True, help="SDG pipeline.")
+@click.option(
+    "--scale-factor",
+    default=30,
+    show_default=True,
+    help="Number of instructions to generate, the sdg_scale_factor pipeline parameter.",
+)
+@click.option(
+    "--batch-size",
+    default=32,
+    show_default=True,
+    help="The sdg_batch_size pipeline parameter.",
+)
+@click.option(
+    "--tokens-per-second",
+    default=1000.0,
+    show_default=True,
+    help="Completion tokens per second of the teacher model.",
+)
+@click.option(
+    "--tokenizer",
+    default="mixtral-tokenizer",
+    show_default=True,
+    type=click.Path(exists=True, file_okay=False),
+    help="Tokenizer of the teacher model.",
+)
+@click.option(
+    "-o",
+    "--output",
+    default="sdg-estimate.json",
+    show_default=True,
+    help="File to write the estimate to.",
+)
+def estimate(
+    taxonomy_path,
+    taxonomy_base,
+    pipeline,
+    scale_factor,
+    batch_size,
+    tokens_per_second,
+    tokenizer,
+    output,
+):
+    """
+    Estimate the SDG teacher requests, tokens and duration for a local taxonomy checkout.
+
+    Preprocesses the taxonomy like sdg_op and runs the sdg_estimate_op component locally, which requires
+    instructlab-sdg to be installed.
+    """
+    import json
+    import os
+    import tempfile
+
+    from instructlab.sdg.generate_data import preprocess_taxonomy
+
+    with tempfile.TemporaryDirectory() as sdg_path:
+        preprocess_taxonomy(
+            taxonomy_path,
+            output_dir=os.path.join(sdg_path, "preprocessed_local"),
+            chunk_word_count=1000,
+            taxonomy_base=taxonomy_base,
+            teacher_model_path=tokenizer,
+        )
+        with open(
+            os.path.join(sdg_path, "sdg_journal.jsonl"), "w", encoding="utf-8"
+        ) as f:
+            f.write(
+                json.dumps(
+                    {
+                        "event": "start",
+                        "date_suffix": "local",
+                        "taxonomy_base": taxonomy_base,
+                    }
+                )
+                + "\n"
+            )
+        sdg_estimate_op.python_func(
+            num_instructions_to_generate=scale_factor,
+            pipeline=pipeline,
+            tokenizer_model=dsl.Model(uri=tokenizer),
+            metrics=dsl.Metrics(),
+            estimate=dsl.Artifact(uri=output),
+            teacher_tokens_per_second=tokens_per_second,
+            sdg_batch_size=batch_size,
+            sdg_path=sdg_path,
+        )
+    if not os.path.exists(output):
+        raise click.ClickException("The SDG work could not be estimated")
+
+
 if __name__ == "__main__":
     cli()
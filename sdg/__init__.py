@@ -1,11 +1,19 @@
 from .components import (
+    sdg_dedup_op,
+    sdg_estimate_op,
     sdg_op,
+    sdg_shard_check_op,
+    sdg_shard_plan_op,
     sdg_to_artifact_op,
     taxonomy_to_artifact_op,
 )
 
 __all__ = [
     "sdg_op",
+    "sdg_dedup_op",
+    "sdg_estimate_op",
+    "sdg_shard_check_op",
+    "sdg_shard_plan_op",
     "taxonomy_to_artifact_op",
     "sdg_to_artifact_op",
 ]
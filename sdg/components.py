@@ -4,7 +4,7 @@ from typing import Optional
 
 from kfp import dsl
 
-from utils.consts import RHELAI_IMAGE, TOOLBOX_IMAGE
+from utils.consts import RHELAI_IMAGE, RUNTIME_GENERIC_IMAGE, TOOLBOX_IMAGE
 
 
 @dsl.component(base_image=RHELAI_IMAGE, install_kfp_package=False)
@@ -14,6 +14,8 @@ def sdg_op(
     tokenizer_model: dsl.Input[dsl.Model],
     repo_branch: Optional[str],
     repo_pr: Optional[int],
+    metrics: dsl.Output[dsl.Metrics],
+    metrics_report: dsl.Output[dsl.Artifact],
     taxonomy_path: str = "/data/taxonomy",
     sdg_path: str = "/data/sdg",
     sdg_sampling_size: float = 1.0,
@@ -22,17 +24,55 @@ def sdg_op(
     sdg_num_cpus: int = None,
     taxonomy_repo_secret: str = None,
     repo_url: str = None,
+    cache_path: str = None,
+    sparse_checkout: bool = False,
+    incremental: bool = False,
+    incremental_cache_size_gb: int = 20,
+    teacher_cache_path: str = "/data/teacher_cache",
+    teacher_cache_size_gb: int = 0,
+    document_cache_size_gb: int = 0,
+    chunk_max_tokens: int = 0,
+    server_ctx_size: int = 0,
+    model_family: str = "mixtral",
+    stage: str = "all",
+    shard_index: int = 0,
+    adaptive_concurrency: bool = False,
+    hedge_requests: bool = False,
+    prefix_ordering: bool = True,
+    leaf_timeout_minutes: float = 0.0,
+    leaf_max_failures: int = 0,
+    http_pool_size: int = 64,
+    http_keepalive_expiry: float = 60.0,
+    http2: bool = False,
+    http_connect_timeout: float = 10.0,
+    http_read_timeout: float = 600.0,
 ):
     import base64
+    import collections
+    import concurrent.futures
+    import fcntl
+    import glob
+    import hashlib
+    import importlib.metadata
+    import inspect
+    import json
+    import multiprocessing
     import os
     import os.path
+    import pathlib
+    import queue
     import re
     import shutil
     import ssl
     import subprocess
     import sys
     import tempfile
+    import threading
+    import time
+    import types
     import urllib.parse
+    import uuid
+    from datetime import datetime
 
     import httpx
     import instructlab.sdg
@@ -40,8 +80,130 @@ def sdg_op(
     import requests
     import xdg_base_dirs
     import yaml
+    from instructlab.sdg.generate_data import (
+        _SYS_PROMPT,
+        generate_taxonomy,
+        generate_taxonomy_eval,
+        mix_datasets,
+        postprocess_taxonomy,
+        preprocess_taxonomy,
+    )
+    from instructlab.sdg.registry import BlockRegistry
+    from instructlab.sdg.utils.chunkers import DocumentChunker
 
     REQUEST_TIMEOUT = 30  # seconds
+    # Bounds of the adaptive concurrency mode
+    ADAPTIVE_MAX_WORKERS = 64
+    ADAPTIVE_MAX_BATCH_SIZE = 4096
+    ADAPTIVE_LATENCY_TOLERANCE = 3.0
+    # Slow teacher requests are duplicated past this percentile of the latency of requests of the same shape,
+    # once enough latencies are known, for up to this fraction of the requests
+    HEDGE_PERCENTILE = 95
+    HEDGE_MIN_SAMPLES = 20
+    HEDGE_MAX_FRACTION = 0.05
+    # The prefix cache of the teacher model server is modelled in blocks of about 16 tokens, enough for 1M tokens
+    PREFIX_BLOCK_CHARS = 64
+    PREFIX_CACHE_BLOCKS = 65536
+    # The knowledge prompts hold a document chunk besides the instructions and the seed examples and the completion
+    # can be as long as the max_tokens of the knowledge pipelines
+    CHUNK_PROMPT_TOKENS = 1536
+    CHUNK_COMPLETION_TOKENS = 2048
+    DEFAULT_TEACHER_CONTEXT_WINDOW = 4096
+    # Same chunk size as the docling HybridChunker used by instructlab-sdg
+    DEFAULT_CHUNK_TOKENS = 500
+    DOCUMENT_FETCH_WORKERS = 8
+
+    if stage not in ("all", "preprocess", "generate", "merge"):
+        raise RuntimeError(
+            f"Unknown SDG stage '{stage}', expected one of all, preprocess, generate or merge"
+        )
+
+    if stage in ("all", "preprocess"):
+        # Preprocessing replaces or calls private functions of instructlab-sdg, fail early when they changed
+        for sdg_function, sdg_parameters in [
+            (
+                instructlab.sdg.utils.taxonomy._get_documents,
+                ["source", "skip_checkout", "document_output_dir"],
+            ),
+            (instructlab.sdg.utils.taxonomy._get_taxonomy, ["repo"]),
+            (instructlab.sdg.utils.taxonomy._get_taxonomy_diff, ["repo_path", "base"]),
+            (DocumentChunker._init_docling_converter, ["self"]),
+            (DocumentChunker.chunk_documents, ["self"]),
+        ]:
+            if list(inspect.signature(sdg_function).parameters) != sdg_parameters:
+                raise RuntimeError(
+                    f"{sdg_function.__module__}.{sdg_function.__qualname__} of instructlab-sdg "
+                    f"{importlib.metadata.version('instructlab-sdg')} doesn't take the parameters "
+                    f"({', '.join(sdg_parameters)}) the SDG component was written for"
+                )
+
+    class ChunkingPool:
+        """Chunks converted documents on a pool of forked worker processes.
+
+        The workers are forked before any threads are started, such as the ones of the document fetcher and the
+        HTTP transports, so that they can't inherit locks held by those threads. The documents and the tokenizer
+        are pickled for each chunking job.
+        """
+
+        def __init__(self, num_workers):
+            mp_context = multiprocessing.get_context("fork")
+            self._jobs = mp_context.Queue()
+            self._results = mp_context.Queue()
+            self.workers = [
+                mp_context.Process(target=self._work, daemon=True)
+                for _ in range(num_workers)
+            ]
+            for worker in self.workers:
+                worker.start()
+
+        def _work(self):
+            # The tokenizer is only used by this process
+            os.environ["TOKENIZERS_PARALLELISM"] = "false"
+            for job in iter(self._jobs.get, None):
+                i, path, document, tokenizer, max_tokens = job
+                from docling_core.transforms.chunker.hybrid_chunker import (
+                    HybridChunker,
+                )
+
+                hybrid_chunker = HybridChunker(
+                    tokenizer=tokenizer, max_tokens=max_tokens
+                )
+                try:
+                    chunks = [
+                        hybrid_chunker.serialize(chunk=chunk)
+                        for chunk in hybrid_chunker.chunk(dl_doc=document)
+                    ]
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    print(f"Error chunking document {path}: {e}")
+                    chunks = []
+                self._results.put((i, chunks))
+
+        def chunk(self, documents, tokenizer, max_tokens):
+            """Returns the chunks of the (path, document) pairs in their order."""
+            for i, (path, document) in enumerate(documents):
+                self._jobs.put((i, path, document, tokenizer, max_tokens))
+            document_chunks = {}
+            while len(document_chunks) < len(documents):
+                try:
+                    i, chunks = self._results.get(timeout=5)
+                except queue.Empty:
+                    if not all(worker.is_alive() for worker in self.workers):
+                        raise RuntimeError("A document chunking worker failed")
+                    continue
+                document_chunks[i] = chunks
+            return [
+                chunk for i in range(len(documents)) for chunk in document_chunks[i]
+            ]
+
+        def close(self):
+            for _ in self.workers:
+                self._jobs.put(None)
+            for worker in self.workers:
+                worker.join()
+
+    chunking_pool = None
+    if stage in ("all", "preprocess") and len(os.sched_getaffinity(0)) > 1:
+        chunking_pool = ChunkingPool(len(os.sched_getaffinity(0)))
 
     def fetch_secret(secret_name, optional=False):
         # Kubernetes API server inside the cluster
@@ -97,6 +259,7 @@ def sdg_op(
         if res.returncode != 0:
             raise RuntimeError(f"CMD {cmd} failed with error code: {res.returncode}")
         print(f"Command {cmd} succeeded.")
+        return res.stdout
 
     def is_ssh(uri: str) -> bool:
         """Checks if a given Git URI is an SSH-based URL."""
@@ -113,6 +276,1330 @@ def sdg_op(
             return match.group(1)  # Extracted host
         raise ValueError(f"Invalid SSH repository URL: {repo_url}")
 
+    def update_taxonomy_mirror(repo_url, cache_path):
+        """Creates or incrementally updates a bare mirror of the taxonomy repo in the cache and returns its path."""
+        mirrors_dir = os.path.join(cache_path, "taxonomy")
+        os.makedirs(mirrors_dir, exist_ok=True)
+        # Key the mirror by repository URL so different taxonomies never share a mirror
+        mirror_key = hashlib.sha256(repo_url.encode()).hexdigest()[:16]
+        mirror_path = os.path.join(mirrors_dir, f"{mirror_key}.git")
+
+        # The cache volume may be shared by concurrent pipeline runs
+        with open(f"{mirror_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            if os.path.exists(os.path.join(mirror_path, "HEAD")):
+                print(f"Updating taxonomy mirror at {mirror_path}...")
+                try:
+                    exec_cmd(
+                        ["git", "remote", "set-url", "origin", repo_url],
+                        cwd=mirror_path,
+                        env=env,
+                    )
+                    exec_cmd(
+                        ["git", "fetch", "--prune", "origin"], cwd=mirror_path, env=env
+                    )
+                except RuntimeError:
+                    print("Failed to update the taxonomy mirror, recreating it...")
+                    shutil.rmtree(mirror_path)
+
+            if not os.path.exists(os.path.join(mirror_path, "HEAD")):
+                print(f"Creating taxonomy mirror at {mirror_path}...")
+                # Clean up any leftovers of an interrupted clone
+                shutil.rmtree(mirror_path, ignore_errors=True)
+                exec_cmd(["git", "clone", "--bare", repo_url, mirror_path], env=env)
+                # Bare clones have no fetch refspec. Only track branches and tags so that
+                # hosting-specific refs (e.g. GitHub's refs/pull/*) are not all downloaded.
+                exec_cmd(
+                    [
+                        "git",
+                        "config",
+                        "remote.origin.fetch",
+                        "+refs/heads/*:refs/heads/*",
+                    ],
+                    cwd=mirror_path,
+                    env=env,
+                )
+                exec_cmd(
+                    [
+                        "git",
+                        "config",
+                        "--add",
+                        "remote.origin.fetch",
+                        "+refs/tags/*:refs/tags/*",
+                    ],
+                    cwd=mirror_path,
+                    env=env,
+                )
+
+            if repo_pr:
+                exec_cmd(
+                    [
+                        "git",
+                        "fetch",
+                        "origin",
+                        f"+pull/{repo_pr}/head:refs/pull/{repo_pr}/head",
+                    ],
+                    cwd=mirror_path,
+                    env=env,
+                )
+
+        return mirror_path
+
+    def sparse_checkout_changed_leaves():
+        """Partially clones the taxonomy and only checks out the leaf nodes changed by repo_branch or repo_pr.
+
+        Returns the commit the changes are based on, to be used as the taxonomy base.
+        """
+        # Blobs are only downloaded for the files that end up being checked out
+        exec_cmd(
+            [
+                "git",
+                "clone",
+                "-v",
+                "--filter=blob:none",
+                "--no-checkout",
+                repo_url,
+                taxonomy_path,
+            ],
+            env=env,
+        )
+        print("Taxonomy repo partially cloned successfully!")
+
+        if repo_branch:
+            target_ref = f"origin/{repo_branch}"
+        else:
+            exec_cmd(
+                ["git", "fetch", "origin", f"pull/{repo_pr}/head:pr-{repo_pr}"],
+                cwd=taxonomy_path,
+                env=env,
+            )
+            target_ref = f"pr-{repo_pr}"
+
+        default_branch_ref = exec_cmd(
+            ["git", "symbolic-ref", "--short", "refs/remotes/origin/HEAD"],
+            cwd=taxonomy_path,
+            env=env,
+        ).strip()
+        base_commit = exec_cmd(
+            ["git", "merge-base", default_branch_ref, target_ref],
+            cwd=taxonomy_path,
+            env=env,
+        ).strip()
+        changed_files = exec_cmd(
+            [
+                "git",
+                "diff",
+                "--name-only",
+                "--no-renames",
+                "--diff-filter=d",
+                base_commit,
+                target_ref,
+            ],
+            cwd=taxonomy_path,
+            env=env,
+        ).splitlines()
+        # A leaf node is the directory of a qna.yaml file. Checking out the whole directory
+        # brings in the files that live next to it such as attribution.txt.
+        leaf_dirs = sorted(
+            {
+                os.path.dirname(f)
+                for f in changed_files
+                if os.path.basename(f) == "qna.yaml" and os.path.dirname(f)
+            }
+        )
+        if not leaf_dirs:
+            print(
+                f"No qna.yaml files changed between {default_branch_ref} and {target_ref}",
+                file=sys.stderr,
+            )
+        else:
+            print(f"Checking out the changed leaf nodes: {', '.join(leaf_dirs)}")
+
+        exec_cmd(
+            ["git", "sparse-checkout", "set", "--cone", *leaf_dirs],
+            cwd=taxonomy_path,
+            env=env,
+        )
+        exec_cmd(
+            ["git", "checkout", repo_branch or f"pr-{repo_pr}"],
+            cwd=taxonomy_path,
+            env=env,
+        )
+
+        # The final evaluation checks out the default and the changed branch in this clone after the git
+        # credentials are removed, so fetch the blobs of the checked out paths of both now instead of lazily.
+        # Cone mode checks out the files next to the leaf nodes' parent directories besides the leaf nodes.
+        parent_dirs = {""}
+        for leaf_dir in leaf_dirs:
+            while leaf_dir:
+                leaf_dir = os.path.dirname(leaf_dir)
+                parent_dirs.add(leaf_dir)
+        checked_out_blobs = set()
+        for ref in sorted({default_branch_ref, target_ref}):
+            tree = subprocess.run(
+                ["git", "ls-tree", "-r", "--full-tree", ref],
+                cwd=taxonomy_path,
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            for entry in tree.splitlines():
+                info, path = entry.split("\t", 1)
+                _, object_type, object_name = info.split()
+                if object_type == "blob" and (
+                    os.path.dirname(path) in parent_dirs
+                    or any(path.startswith(f"{d}/") for d in leaf_dirs)
+                ):
+                    checked_out_blobs.add(object_name)
+        # The same fetch git runs for missing objects of a partial clone
+        subprocess.run(
+            [
+                "git",
+                "-c",
+                "fetch.negotiationAlgorithm=noop",
+                "fetch",
+                "origin",
+                "--no-tags",
+                "--no-write-fetch-head",
+                "--recurse-submodules=no",
+                "--filter=blob:none",
+                "--stdin",
+            ],
+            input="\n".join(sorted(checked_out_blobs)) + "\n",
+            cwd=taxonomy_path,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        print(
+            f"Fetched {len(checked_out_blobs)} files of the checked out leaf nodes on {default_branch_ref} and "
+            f"{target_ref}"
+        )
+
+        return base_commit
+
+    class PooledTransport(httpx.BaseTransport):
+        """An httpx transport with a keep-alive connection pool sized for concurrent requests.
+
+        The default httpx pool only keeps 20 idle connections, so at higher concurrency connections are closed
+        and reopened with a new TLS handshake. Requests, new connections, TLS handshakes and errors are counted
+        per endpoint.
+        """
+
+        def __init__(self, pool_size, keepalive_expiry, http2):
+            if http2:
+                try:
+                    import h2  # noqa: F401
+                except ImportError:
+                    print("HTTP/2 requires the h2 package, falling back to HTTP/1.1")
+                    http2 = False
+            # Use the default SSL context since it leverages OpenSSL to use the correct CA bundle.
+            self._transport = httpx.HTTPTransport(
+                verify=ssl.create_default_context(),
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+            )
+            self._lock = threading.Lock()
+            self.stats = collections.defaultdict(collections.Counter)
+
+        def handle_request(self, request):
+            stats = self.stats[f"{request.url.scheme}://{request.url.netloc.decode()}"]
+
+            def trace(event_name, info):
+                if event_name == "connection.connect_tcp.complete":
+                    with self._lock:
+                        stats["connections"] += 1
+                elif event_name == "connection.start_tls.complete":
+                    with self._lock:
+                        stats["tls_handshakes"] += 1
+
+            request.extensions["trace"] = trace
+            with self._lock:
+                stats["requests"] += 1
+            try:
+                return self._transport.handle_request(request)
+            except httpx.TransportError:
+                with self._lock:
+                    stats["errors"] += 1
+                raise
+
+        def print_stats(self):
+            for endpoint, stats in sorted(self.stats.items()):
+                print(
+                    f"{endpoint}: {stats['requests']} requests, {stats['connections']} new connections, "
+                    f"{stats['tls_handshakes']} TLS handshakes, {stats['errors']} connection errors"
+                )
+
+        def close(self):
+            self._transport.close()
+
+    class EndpointRouterTransport(httpx.BaseTransport):
+        """Spreads the requests to a model server over its replicas.
+
+        Requests to the first endpoint are sent to the replica with the fewest outstanding requests, then the
+        lowest recent latency. A replica failing max_failures requests in a row, with connection errors or 5xx
+        responses, is ejected for eject_seconds. Requests to other servers are passed through.
+        """
+
+        def __init__(self, transport, endpoints, max_failures=3, eject_seconds=30.0):
+            self._transport = transport
+            self._endpoints = endpoints
+            self._max_failures = max_failures
+            self._eject_seconds = eject_seconds
+            self._lock = threading.Lock()
+            self.replicas = {
+                endpoint: {
+                    "outstanding": 0,
+                    "latency": 0.0,
+                    "failures": 0,
+                    "ejected_until": 0.0,
+                    "requests": 0,
+                    "ejections": 0,
+                }
+                for endpoint in endpoints
+            }
+            # Requests are matched on the parsed URLs, which httpx normalizes the same way as the request URLs
+            self._urls = {
+                endpoint: httpx.URL(endpoint.rstrip("/")) for endpoint in endpoints
+            }
+
+        def _pick(self, exclude=()):
+            now = time.monotonic()
+            candidates = [
+                endpoint
+                for endpoint, replica in self.replicas.items()
+                if replica["ejected_until"] <= now and endpoint not in exclude
+            ]
+            if not candidates:
+                # Without a healthy replica, try the one that is back the soonest
+                return min(
+                    self.replicas,
+                    key=lambda endpoint: self.replicas[endpoint]["ejected_until"],
+                )
+            return min(
+                candidates,
+                key=lambda endpoint: (
+                    self.replicas[endpoint]["outstanding"],
+                    self.replicas[endpoint]["latency"],
+                ),
+            )
+
+        def _record(self, endpoint, start, failed):
+            with self._lock:
+                replica = self.replicas[endpoint]
+                replica["outstanding"] -= 1
+                if not failed:
+                    replica["failures"] = 0
+                    # Exponentially weighted moving average of the response latency
+                    latency = time.monotonic() - start
+                    replica["latency"] = (
+                        latency
+                        if not replica["latency"]
+                        else 0.8 * replica["latency"] + 0.2 * latency
+                    )
+                    return
+                replica["failures"] += 1
+                if replica["failures"] >= self._max_failures:
+                    replica["failures"] = 0
+                    replica["ejected_until"] = time.monotonic() + self._eject_seconds
+                    replica["ejections"] += 1
+                    print(
+                        f"Ejecting {endpoint} for {self._eject_seconds}s after {self._max_failures} failures"
+                    )
+
+        def _relative_path(self, url):
+            """Returns the path of url below the first endpoint, or None when url isn't for the model server."""
+            base_url = self._urls[self._endpoints[0]]
+            if (url.scheme, url.host, url.port) != (
+                base_url.scheme,
+                base_url.host,
+                base_url.port,
+            ):
+                return None
+            base_path = base_url.path.rstrip("/")
+            if url.path != base_path and not url.path.startswith(f"{base_path}/"):
+                return None
+            return url.path[len(base_path) :]
+
+        def handle_request(self, request):
+            relative_path = (
+                self._relative_path(request.url) if len(self._endpoints) > 1 else None
+            )
+            if relative_path is None:
+                return self._transport.handle_request(request)
+
+            headers = request.headers.copy()
+            del headers["host"]
+            tried = set(request.extensions.get("exclude_endpoints", ()))
+            while True:
+                with self._lock:
+                    endpoint = self._pick(tried)
+                    self.replicas[endpoint]["outstanding"] += 1
+                    self.replicas[endpoint]["requests"] += 1
+                tried.add(endpoint)
+                request.extensions["endpoint"] = endpoint
+                routed_request = httpx.Request(
+                    request.method,
+                    request.url.copy_with(
+                        scheme=self._urls[endpoint].scheme,
+                        host=self._urls[endpoint].host,
+                        port=self._urls[endpoint].port,
+                        path=self._urls[endpoint].path.rstrip("/") + relative_path,
+                    ),
+                    headers=headers,
+                    content=request.content,
+                    extensions=request.extensions,
+                )
+
+                start = time.monotonic()
+                try:
+                    response = self._transport.handle_request(routed_request)
+                except httpx.ConnectError:
+                    self._record(endpoint, start, failed=True)
+                    # The request was not sent, so it can go to another replica
+                    if len(tried) < len(self._endpoints):
+                        continue
+                    raise
+                except httpx.TransportError:
+                    self._record(endpoint, start, failed=True)
+                    raise
+                self._record(endpoint, start, failed=response.status_code >= 500)
+                return response
+
+        def print_stats(self):
+            if len(self._endpoints) < 2:
+                return
+            for endpoint, replica in self.replicas.items():
+                print(
+                    f"{endpoint}: {replica['requests']} requests routed, {replica['ejections']} ejections"
+                )
+
+        def close(self):
+            self._transport.close()
+
+    class TeacherMetricsTransport(httpx.BaseTransport):
+        """Records the latency, token usage, retries and errors of every teacher request.
+
+        Requests are attributed to the SDG pipeline block that sent them. The time during which at least one
+        request was in flight is tracked to tell whether SDG was waiting on the teacher model or on local work.
+        """
+
+        def __init__(self, transport):
+            self._transport = transport
+            self._lock = threading.Lock()
+            self._in_flight = 0
+            self._busy_start = 0.0
+            self.busy_time = 0.0
+            self.requests = []
+
+        def handle_request(self, request):
+            with self._lock:
+                if self._in_flight == 0:
+                    self._busy_start = time.monotonic()
+                self._in_flight += 1
+            record = {
+                # Requests sent from other threads, e.g. by the hedging transport, carry the block of their sender
+                "block": request.extensions.get(
+                    "block", getattr(block_context, "name", None)
+                ),
+                # Set by the openai client on retried requests
+                "retry": int(request.headers.get("x-stainless-retry-count", 0)) > 0,
+                "error": True,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                **request.extensions.get(
+                    "prefix_sharing", {"prompt_chars": 0, "shared_prefix_chars": 0}
+                ),
+                "throttled_time": request.extensions.get("throttled_time", 0.0),
+            }
+            start = time.monotonic()
+            try:
+                response = self._transport.handle_request(request)
+                response.read()
+                record["error"] = response.status_code != 200
+                if response.status_code == 200:
+                    try:
+                        usage = json.loads(response.content).get("usage") or {}
+                    except (ValueError, AttributeError):
+                        usage = {}
+                    record["prompt_tokens"] = usage.get("prompt_tokens") or 0
+                    record["completion_tokens"] = usage.get("completion_tokens") or 0
+                return response
+            finally:
+                end = time.monotonic()
+                record["latency"] = end - start
+                with self._lock:
+                    self.requests.append(record)
+                    self._in_flight -= 1
+                    if self._in_flight == 0:
+                        self.busy_time += end - self._busy_start
+
+        def close(self):
+            self._transport.close()
+
+    class PrefixOrderingTransport(httpx.BaseTransport):
+        """Orders the prompts of batched completion requests so that prompts sharing a prefix are sent together.
+
+        The prompts of an SDG batch share their system prompt and seed examples with some of the other prompts,
+        and the teacher model server schedules them in order, so sorted prompts are more likely to reuse the
+        prefix cache entries of the previous ones. The choices of the response are put back in the original
+        order. The share of prompt characters found in a modelled least recently used prefix cache is recorded
+        for each request.
+        """
+
+        def __init__(self, transport):
+            self._transport = transport
+            self._lock = threading.Lock()
+            self._prefix_cache = collections.OrderedDict()
+
+        def _shared_prefix_chars(self, prompt):
+            shared_chars = 0
+            block_hash = None
+            with self._lock:
+                for i in range(0, len(prompt), PREFIX_BLOCK_CHARS):
+                    block_hash = hash((block_hash, prompt[i : i + PREFIX_BLOCK_CHARS]))
+                    if block_hash in self._prefix_cache:
+                        self._prefix_cache.move_to_end(block_hash)
+                        if shared_chars == i:
+                            shared_chars = min(i + PREFIX_BLOCK_CHARS, len(prompt))
+                    else:
+                        self._prefix_cache[block_hash] = None
+                        if len(self._prefix_cache) > PREFIX_CACHE_BLOCKS:
+                            self._prefix_cache.popitem(last=False)
+            return shared_chars
+
+        def handle_request(self, request):
+            if request.method != "POST" or not request.url.path.endswith(
+                "/completions"
+            ):
+                return self._transport.handle_request(request)
+            try:
+                body = json.loads(request.content)
+            except ValueError:
+                return self._transport.handle_request(request)
+
+            prompts = body.get("prompt")
+            if body.get("messages") is not None:
+                prompts = [json.dumps(body["messages"])]
+            elif isinstance(prompts, str):
+                prompts = [prompts]
+            if not isinstance(prompts, list) or not all(
+                isinstance(prompt, str) for prompt in prompts
+            ):
+                return self._transport.handle_request(request)
+
+            order = None
+            if len(prompts) > 1 and not body.get("stream"):
+                order = sorted(range(len(prompts)), key=prompts.__getitem__)
+                if order != list(range(len(prompts))):
+                    body["prompt"] = prompts = [prompts[i] for i in order]
+                    headers = request.headers.copy()
+                    del headers["content-length"]
+                    request = httpx.Request(
+                        request.method,
+                        request.url,
+                        headers=headers,
+                        content=json.dumps(body).encode(),
+                        extensions=request.extensions,
+                    )
+                else:
+                    order = None
+
+            request.extensions["prefix_sharing"] = {
+                "prompt_chars": sum(len(prompt) for prompt in prompts),
+                "shared_prefix_chars": sum(
+                    self._shared_prefix_chars(prompt) for prompt in prompts
+                ),
+            }
+            response = self._transport.handle_request(request)
+            if order is None or response.status_code != 200:
+                return response
+
+            response.read()
+            try:
+                content = json.loads(response.content)
+                choices = sorted(content["choices"], key=lambda c: c["index"])
+            except (ValueError, KeyError, TypeError):
+                return response
+            # Each prompt has n choices, in the order of the prompts
+            n = body.get("n") or 1
+            if len(choices) != len(prompts) * n:
+                return response
+            original_choices = [None] * len(choices)
+            for position, prompt_index in enumerate(order):
+                for j in range(n):
+                    choice = choices[position * n + j]
+                    choice["index"] = prompt_index * n + j
+                    original_choices[prompt_index * n + j] = choice
+            content["choices"] = original_choices
+            headers = response.headers.copy()
+            for header in ("content-length", "content-encoding", "transfer-encoding"):
+                if header in headers:
+                    del headers[header]
+            return httpx.Response(
+                response.status_code,
+                headers=headers,
+                content=json.dumps(content).encode(),
+                request=request,
+                extensions=response.extensions,
+            )
+
+        def close(self):
+            self._transport.close()
+
+    class HedgingTransport(httpx.BaseTransport):
+        """Sends a duplicate of a teacher completion request that is slower than usual and takes the first response.
+
+        The deadline is a percentile of the latency of recent requests of the same shape. The duplicate goes to
+        another replica of the teacher model server if there is one, and the duplicates are capped to a fraction
+        of the requests. The responses that lose are read and discarded in the background.
+        """
+
+        def __init__(self, transport, percentile, min_samples, max_fraction):
+            self._transport = transport
+            self._percentile = percentile
+            self._min_samples = min_samples
+            self._max_fraction = max_fraction
+            self._lock = threading.Lock()
+            self._latencies = collections.defaultdict(
+                lambda: collections.deque(maxlen=200)
+            )
+            # Both copies of a hedged request are waiting on their response at the same time
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=2 * ADAPTIVE_MAX_WORKERS
+            )
+            self.requests = 0
+            self.hedged = 0
+            self.hedge_wins = 0
+            self.latency_saved = 0.0
+
+        def _shape(self, request):
+            try:
+                body = json.loads(request.content)
+            except ValueError:
+                return None
+            if body.get("stream"):
+                return None
+            return (
+                request.url.path,
+                body.get("max_tokens"),
+                body.get("n"),
+                len(body["prompt"]) if isinstance(body.get("prompt"), list) else 1,
+            )
+
+        def _deadline(self, shape):
+            with self._lock:
+                latencies = sorted(self._latencies[shape])
+                if len(latencies) < self._min_samples:
+                    return None
+                if self.hedged >= self.requests * self._max_fraction:
+                    return None
+                return latencies[round(self._percentile / 100 * (len(latencies) - 1))]
+
+        def _send(self, request):
+            start = time.monotonic()
+            response = self._transport.handle_request(request)
+            response.read()
+            return response, time.monotonic() - start
+
+        def _on_losing_response(self, future, winner_end):
+            try:
+                response, _ = future.result()
+            except httpx.HTTPError:
+                return
+            response.close()
+            with self._lock:
+                self.latency_saved += max(0.0, time.monotonic() - winner_end)
+
+        def handle_request(self, request):
+            if request.method != "POST" or not request.url.path.endswith(
+                "/completions"
+            ):
+                return self._transport.handle_request(request)
+            shape = self._shape(request)
+            if shape is None:
+                return self._transport.handle_request(request)
+            with self._lock:
+                self.requests += 1
+            # The requests are sent from the threads of the executor, which don't see the block of this thread
+            request.extensions.setdefault("block", getattr(block_context, "name", None))
+
+            primary_request = httpx.Request(
+                request.method,
+                request.url,
+                headers=request.headers,
+                content=request.content,
+                extensions=dict(request.extensions),
+            )
+            start = time.monotonic()
+            primary = self._executor.submit(self._send, primary_request)
+            deadline = self._deadline(shape)
+            done, _ = concurrent.futures.wait([primary], timeout=deadline)
+            if done:
+                response, latency = primary.result()
+                if response.status_code == 200:
+                    with self._lock:
+                        self._latencies[shape].append(latency)
+                return response
+
+            with self._lock:
+                self.hedged += 1
+            hedge_extensions = dict(request.extensions)
+            # The router records the replica of the first request
+            hedge_extensions["exclude_endpoints"] = [
+                primary_request.extensions.get("endpoint")
+            ]
+            hedge = self._executor.submit(
+                self._send,
+                httpx.Request(
+                    request.method,
+                    request.url,
+                    headers=request.headers,
+                    content=request.content,
+                    extensions=hedge_extensions,
+                ),
+            )
+            pending = {primary, hedge}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    try:
+                        response, _ = future.result()
+                    except httpx.HTTPError:
+                        if pending:
+                            continue
+                        raise
+                    if response.status_code != 200 and pending:
+                        continue
+                    winner_end = time.monotonic()
+                    if response.status_code == 200:
+                        with self._lock:
+                            self._latencies[shape].append(winner_end - start)
+                    for losing_future in pending:
+                        losing_future.add_done_callback(
+                            lambda f: self._on_losing_response(f, winner_end)
+                        )
+                    if future is hedge:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    return response
+
+        def close(self):
+            self._executor.shutdown(wait=False)
+            self._transport.close()
+
+    class AdaptiveConcurrencyTransport(httpx.BaseTransport):
+        """Limits the in-flight teacher requests with additive-increase/multiplicative-decrease (AIMD).
+
+        The limit grows by one for every limit's worth of responses and is halved on 429 and 5xx responses (OpenShift
+        routes report an overloaded server as 502 or 504), connection errors and timeouts, or when the latency per
+        generated token exceeds the fastest one seen for requests of the same shape by the latency tolerance factor.
+        The limit is decreased at most once per round trip so that the requests already in flight during the
+        congestion don't shrink it further.
+        """
+
+        def __init__(self, transport, initial_limit, max_limit, latency_tolerance):
+            self._transport = transport
+            self._max_limit = max_limit
+            self._latency_tolerance = latency_tolerance
+            self._cond = threading.Condition()
+            self._in_flight = 0
+            self._last_decrease = 0.0
+            self._min_token_latency = {}
+            self.limit = float(min(initial_limit, max_limit))
+            self.congestion_events = 0
+
+        def _on_response(self, start, congested):
+            with self._cond:
+                self._in_flight -= 1
+                if congested:
+                    if start > self._last_decrease:
+                        self.limit = max(1.0, self.limit / 2)
+                        self._last_decrease = time.monotonic()
+                        self.congestion_events += 1
+                else:
+                    self.limit = min(
+                        float(self._max_limit), self.limit + 1 / self.limit
+                    )
+                self._cond.notify_all()
+
+        def handle_request(self, request):
+            with self._cond:
+                while self._in_flight >= int(self.limit):
+                    self._cond.wait()
+                self._in_flight += 1
+
+            start = time.monotonic()
+            try:
+                response = self._transport.handle_request(request)
+                response.read()
+            except httpx.TransportError:
+                self._on_response(start, congested=True)
+                raise
+
+            congested = response.status_code == 429 or response.status_code >= 500
+            if response.status_code == 200:
+                try:
+                    completion_tokens = json.loads(response.content)["usage"][
+                        "completion_tokens"
+                    ]
+                except (ValueError, KeyError, TypeError):
+                    completion_tokens = None
+                if completion_tokens:
+                    token_latency = (time.monotonic() - start) / completion_tokens
+                    # The prompt processing time depends on the block, so only compare requests of the same shape
+                    try:
+                        body = json.loads(request.content)
+                        shape = (
+                            request.url.path,
+                            body.get("max_tokens"),
+                            body.get("n"),
+                            len(body["prompt"])
+                            if isinstance(body.get("prompt"), list)
+                            else 1,
+                        )
+                    except (ValueError, AttributeError):
+                        shape = request.url.path
+                    with self._cond:
+                        min_token_latency = min(
+                            token_latency,
+                            self._min_token_latency.get(shape, token_latency),
+                        )
+                        self._min_token_latency[shape] = min_token_latency
+                        congested = (
+                            token_latency > min_token_latency * self._latency_tolerance
+                        )
+            self._on_response(start, congested)
+            return response
+
+        def close(self):
+            self._transport.close()
+
+    class RateLimitTransport(httpx.BaseTransport):
+        """Paces the teacher requests to the requests and tokens per minute quota of the teacher model server.
+
+        Two token buckets refill continuously and hold up to a minute of quota, a request waits until both can
+        pay for it. The tokens of a request are estimated from its prompts and max_tokens, and corrected with the
+        usage of the response. A 429 response empties the buckets so that all workers back off together instead
+        of retrying into the quota.
+        """
+
+        def __init__(self, transport, requests_per_minute, tokens_per_minute):
+            self._transport = transport
+            self._cond = threading.Condition()
+            # A quota of 0 is unlimited
+            self._capacity = {
+                name: quota
+                for name, quota in (
+                    ("requests", requests_per_minute),
+                    ("tokens", tokens_per_minute),
+                )
+                if quota > 0
+            }
+            self._available = dict(self._capacity)
+            self._updated = time.monotonic()
+            self.throttled_time = 0.0
+
+        def _refill(self):
+            now = time.monotonic()
+            for name, capacity in self._capacity.items():
+                self._available[name] = min(
+                    capacity,
+                    self._available[name] + (now - self._updated) * capacity / 60,
+                )
+            self._updated = now
+
+        def _estimate_tokens(self, request):
+            try:
+                body = json.loads(request.content)
+            except ValueError:
+                return 0
+            prompts = body.get("prompt") or ""
+            if body.get("messages") is not None:
+                prompts = json.dumps(body["messages"])
+            if isinstance(prompts, str):
+                prompts = [prompts]
+            # About 4 characters per token
+            prompt_tokens = sum(len(str(prompt)) for prompt in prompts) // 4
+            completion_tokens = (body.get("max_tokens") or 0) * (body.get("n") or 1)
+            return prompt_tokens + completion_tokens * len(prompts)
+
+        def handle_request(self, request):
+            tokens = self._estimate_tokens(request)
+            # A request larger than the bucket only waits for a full bucket
+            cost = {
+                "requests": 1,
+                "tokens": min(tokens, self._capacity.get("tokens", tokens)),
+            }
+            start = time.monotonic()
+            with self._cond:
+                while True:
+                    self._refill()
+                    wait = max(
+                        (cost[name] - self._available[name]) * 60 / capacity
+                        for name, capacity in self._capacity.items()
+                    )
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                for name in self._capacity:
+                    self._available[name] -= cost[name]
+                throttled = time.monotonic() - start
+                self.throttled_time += throttled
+            request.extensions["throttled_time"] = throttled
+
+            response = self._transport.handle_request(request)
+            if response.status_code == 429:
+                try:
+                    retry_after = float(response.headers.get("retry-after", 0))
+                except ValueError:
+                    retry_after = 0.0
+                with self._cond:
+                    self._refill()
+                    for name, capacity in self._capacity.items():
+                        self._available[name] = min(
+                            self._available[name], -retry_after * capacity / 60
+                        )
+            elif response.status_code == 200 and "tokens" in self._capacity:
+                response.read()
+                try:
+                    used_tokens = json.loads(response.content)["usage"]["total_tokens"]
+                except (ValueError, KeyError, TypeError):
+                    used_tokens = None
+                if used_tokens is not None:
+                    with self._cond:
+                        self._available["tokens"] += cost["tokens"] - used_tokens
+                        self._cond.notify_all()
+            return response
+
+        def close(self):
+            self._transport.close()
+
+    class LeafGuardTransport(httpx.BaseTransport):
+        """Bounds the teacher requests of a taxonomy leaf node with a wall-clock budget and a circuit breaker.
+
+        The circuit opens after max_failures consecutive failed requests (connection errors, timeouts and 5xx
+        responses) or once the budget of the leaf node is spent. Requests in flight can't outlive the budget, and
+        while the circuit is open requests fail right away so that the SDG pipeline of the leaf node gives up
+        quickly instead of retrying the teacher until the leaf node completes.
+        """
+
+        def __init__(self, transport, timeout, max_failures):
+            self._transport = transport
+            self._timeout = timeout
+            self._max_failures = max_failures
+            self._lock = threading.Lock()
+            self._deadline = None
+            self._failures = 0
+            self.reason = None
+
+        def start_leaf(self):
+            with self._lock:
+                self._deadline = (
+                    time.monotonic() + self._timeout if self._timeout else None
+                )
+                self._failures = 0
+                self.reason = None
+
+        def end_leaf(self):
+            with self._lock:
+                self._deadline = None
+                self._failures = 0
+
+        def _on_response(self, failed):
+            with self._lock:
+                if not failed:
+                    self._failures = 0
+                    return
+                self._failures += 1
+                if (
+                    self._max_failures
+                    and self._failures >= self._max_failures
+                    and not self.reason
+                ):
+                    self.reason = (
+                        f"{self._failures} consecutive failed teacher requests"
+                    )
+
+        def handle_request(self, request):
+            remaining = None
+            with self._lock:
+                if self._deadline is not None:
+                    remaining = self._deadline - time.monotonic()
+                    if remaining <= 0 and not self.reason:
+                        self.reason = f"exceeded the budget of {self._timeout:.0f}s"
+                reason = self.reason
+            if reason:
+                raise httpx.TransportError(
+                    f"The leaf node is quarantined, {reason}", request=request
+                )
+            if remaining is not None:
+                timeout = dict(request.extensions.get("timeout") or {})
+                for name in ("connect", "read", "write", "pool"):
+                    timeout[name] = min(timeout.get(name) or remaining, remaining)
+                request.extensions["timeout"] = timeout
+
+            try:
+                response = self._transport.handle_request(request)
+            except httpx.TransportError:
+                self._on_response(failed=True)
+                raise
+            self._on_response(failed=response.status_code >= 500)
+            return response
+
+        def close(self):
+            self._transport.close()
+
+    class LRUCacheDir:
+        """A directory of cache entries bounded in size, the least recently used entries are evicted first.
+
+        Entries are files named after their key, spread over subdirectories by the first characters of the key and
+        written atomically so concurrent readers never see a partial entry. Reading an entry refreshes its
+        modification time, which orders the eviction.
+        """
+
+        def __init__(self, cache_dir, max_size_bytes):
+            self.cache_dir = cache_dir
+            self._max_size_bytes = max_size_bytes
+            self._lock = threading.Lock()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+            os.makedirs(cache_dir, exist_ok=True)
+            self._size_bytes = sum(
+                os.path.getsize(f) for f in glob.glob(os.path.join(cache_dir, "*", "*"))
+            )
+
+        def _path(self, key):
+            return os.path.join(self.cache_dir, key[:2], key)
+
+        def _evict(self):
+            # Called with the lock held, entries being written have a temporary name and are skipped
+            entries = sorted(
+                (os.path.getmtime(f), f)
+                for f in glob.glob(os.path.join(self.cache_dir, "*", "*"))
+                if ".tmp-" not in f
+            )
+            target_size = self._max_size_bytes * 0.9
+            for _, f in entries:
+                if self._size_bytes <= target_size:
+                    break
+                try:
+                    size = os.path.getsize(f)
+                    os.remove(f)
+                except FileNotFoundError:
+                    continue
+                self._size_bytes -= size
+                self.evictions += 1
+
+        def get(self, key):
+            """Returns the contents of the entry, or None when it isn't cached."""
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    content = f.read()
+                os.utime(path)
+            except FileNotFoundError:
+                with self._lock:
+                    self.misses += 1
+                return None
+            with self._lock:
+                self.hits += 1
+            return content
+
+        def put(self, key, content):
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp-{uuid.uuid4().hex}"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            with self._lock:
+                try:
+                    replaced_size = os.path.getsize(path)
+                except FileNotFoundError:
+                    replaced_size = 0
+                os.replace(tmp_path, path)
+                self._size_bytes += len(content) - replaced_size
+                if self._size_bytes > self._max_size_bytes:
+                    self._evict()
+
+    class TeacherCacheTransport(httpx.BaseTransport):
+        """An on-disk cache of teacher completion responses with size-bounded LRU eviction.
+
+        Responses are keyed on the request body, which holds the model, the prompt or messages and the sampling
+        parameters. Identical requests are commonly sent several times on purpose to get different samples, so the
+        key also includes how many times the same request was already sent in this process. A retried run sends
+        the same sequence of requests and gets the same responses back without calling the teacher model.
+        """
+
+        def __init__(self, transport, cache_dir, max_size_bytes):
+            self._transport = transport
+            self.cache = LRUCacheDir(cache_dir, max_size_bytes)
+            self._lock = threading.Lock()
+            self._occurrences = collections.Counter()
+
+        def _cache_key(self, request):
+            if request.method != "POST" or not request.url.path.endswith(
+                "/completions"
+            ):
+                return None
+            try:
+                body = json.loads(request.content)
+            except ValueError:
+                return None
+            if body.get("stream"):
+                return None
+
+            request_key = json.dumps(body, sort_keys=True)
+            with self._lock:
+                occurrence = self._occurrences[request_key]
+                self._occurrences[request_key] += 1
+            key = hashlib.sha256(f"{request_key}#{occurrence}".encode()).hexdigest()
+            return f"{key}.json"
+
+        def handle_request(self, request):
+            cache_key = self._cache_key(request)
+            if cache_key is None:
+                return self._transport.handle_request(request)
+
+            content = self.cache.get(cache_key)
+            if content is not None:
+                return httpx.Response(
+                    200,
+                    headers={"content-type": "application/json"},
+                    content=content,
+                    request=request,
+                )
+
+            response = self._transport.handle_request(request)
+            if response.status_code == 200:
+                self.cache.put(cache_key, response.read())
+            return response
+
+        def close(self):
+            self._transport.close()
+
+    class DocumentCacheConverter:
+        """A docling document converter serving the conversions of knowledge documents from a size-bounded cache.
+
+        Conversions are keyed on the source repository and commit of the document, its contents and the docling
+        version, and stored as docling JSON with least recently used entries evicted first. Documents that aren't
+        cached are converted by the wrapped converter.
+        """
+
+        def __init__(self, cache_dir, max_size_bytes):
+            self.converter = None
+            self.cache = LRUCacheDir(cache_dir, max_size_bytes)
+            self._sources = {}
+
+        def __getattr__(self, name):
+            return getattr(self.converter, name)
+
+        def _source(self, directory):
+            # The documents of a leaf node are all in the clone of its document repository
+            if directory not in self._sources:
+                source = []
+                for cmd in (
+                    ["git", "config", "--get", "remote.origin.url"],
+                    ["git", "rev-parse", "HEAD"],
+                ):
+                    result = subprocess.run(
+                        cmd, cwd=directory, capture_output=True, text=True, check=False
+                    )
+                    source.append(result.stdout.strip())
+                self._sources[directory] = tuple(source)
+            return self._sources[directory]
+
+        def _cache_key(self, path):
+            repo, commit = self._source(os.path.dirname(os.path.abspath(path)))
+            file_hash = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    file_hash.update(block)
+            key = hashlib.sha256(
+                json.dumps(
+                    [
+                        repo,
+                        commit,
+                        file_hash.hexdigest(),
+                        importlib.metadata.version("docling"),
+                    ]
+                ).encode()
+            ).hexdigest()
+            return f"{key}.json"
+
+        def convert_all(self, source, **kwargs):
+            from docling.datamodel.base_models import ConversionStatus
+            from docling_core.types.doc import DoclingDocument
+
+            paths = list(source)
+            cache_keys = {path: self._cache_key(path) for path in paths}
+            documents = {}
+            for path in paths:
+                content = self.cache.get(cache_keys[path])
+                if content is not None:
+                    documents[path] = DoclingDocument.model_validate_json(content)
+            missed = [path for path in paths if path not in documents]
+
+            # The documents are returned in their original order, which sets the order of the chunks
+            converted = iter(
+                self.converter.convert_all(missed, **kwargs) if missed else []
+            )
+            for path in paths:
+                if path in documents:
+                    # Only the document and its source file are used by the chunker
+                    yield types.SimpleNamespace(
+                        document=documents[path],
+                        input=types.SimpleNamespace(file=path),
+                        status=ConversionStatus.SUCCESS,
+                    )
+                    continue
+
+                result = next(converted)
+                if result.status == ConversionStatus.SUCCESS:
+                    self.cache.put(
+                        cache_keys[path], result.document.model_dump_json().encode()
+                    )
+                yield result
+
+    class DocumentRepoFetcher:
+        """Fetches the document repositories of knowledge leaf nodes in parallel, once per repository and commit.
+
+        Each repository is mirrored in mirrors_dir, which persists across runs when it's in the cache volume, and
+        only fetched again when a commit it doesn't have yet is needed. The leaf nodes get clones of the mirror
+        checked out at their commit, with the origin of the original repository so that they can't be told apart
+        from the clones made by instructlab-sdg.
+        """
+
+        def __init__(self, mirrors_dir, max_workers):
+            self._mirrors_dir = mirrors_dir
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+            self._lock = threading.Lock()
+            self._fetches = {}
+            self.hits = 0
+            self.fetches = 0
+
+            os.makedirs(mirrors_dir, exist_ok=True)
+
+        def _git(self, *args, cwd=None):
+            result = subprocess.run(
+                ["git", *args], cwd=cwd, capture_output=True, text=True, check=False
+            )
+            if result.returncode != 0:
+                raise RuntimeError(
+                    f"git {' '.join(args)} failed with error code {result.returncode}: {result.stderr}"
+                )
+            return result.stdout
+
+        def _has_commit(self, mirror_dir, commit):
+            return (
+                subprocess.run(
+                    ["git", "cat-file", "-e", f"{commit}^{{commit}}"],
+                    cwd=mirror_dir,
+                    capture_output=True,
+                    check=False,
+                ).returncode
+                == 0
+            )
+
+        def _fetch(self, repo_url, commit):
+            mirror_dir = os.path.join(
+                self._mirrors_dir, hashlib.sha256(repo_url.encode()).hexdigest()
+            )
+            with open(f"{mirror_dir}.lock", "a", encoding="utf-8") as lock_file:
+                # Concurrent runs sharing the cache volume update a mirror one at a time
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if commit and os.path.isdir(mirror_dir):
+                    if self._has_commit(mirror_dir, commit):
+                        with self._lock:
+                            self.hits += 1
+                        return mirror_dir
+
+                if not os.path.isdir(mirror_dir):
+                    tmp_mirror_dir = f"{mirror_dir}.tmp-{uuid.uuid4().hex}"
+                    self._git("clone", "--quiet", "--bare", repo_url, tmp_mirror_dir)
+                    # Bare clones have no fetch refspec. Only track branches and tags so that
+                    # hosting-specific refs (e.g. GitHub's refs/pull/*) are not all downloaded.
+                    self._git(
+                        "config",
+                        "remote.origin.fetch",
+                        "+refs/heads/*:refs/heads/*",
+                        cwd=tmp_mirror_dir,
+                    )
+                    self._git(
+                        "config",
+                        "--add",
+                        "remote.origin.fetch",
+                        "+refs/tags/*:refs/tags/*",
+                        cwd=tmp_mirror_dir,
+                    )
+                    os.rename(tmp_mirror_dir, mirror_dir)
+                else:
+                    # Without a commit the latest default branch is used
+                    self._git("fetch", "--quiet", "--prune", "origin", cwd=mirror_dir)
+                if commit and not self._has_commit(mirror_dir, commit):
+                    # A commit that no branch or tag points to, e.g. of a pull request, is fetched on its own
+                    self._git(
+                        "fetch",
+                        "--quiet",
+                        "origin",
+                        f"+{commit}:refs/commits/{commit}",
+                        cwd=mirror_dir,
+                    )
+                with self._lock:
+                    self.fetches += 1
+            return mirror_dir
+
+        def _mirror(self, repo_url, commit):
+            with self._lock:
+                key = (repo_url, commit)
+                if key not in self._fetches:
+                    self._fetches[key] = self._executor.submit(
+                        self._fetch, repo_url, commit
+                    )
+                return self._fetches[key]
+
+        def prefetch(self, sources):
+            for source in sources:
+                self._mirror(source.get("repo"), source.get("commit"))
+
+        def get_documents(self, source, skip_checkout=False, document_output_dir=None):
+            """Same as instructlab.sdg.utils.taxonomy._get_documents, but clones the mirror of the repository."""
+            repo_url = source.get("repo")
+            commit = source.get("commit")
+            mirror_dir = self._mirror(repo_url, commit).result()
+
+            self._git("clone", "--quiet", mirror_dir, str(document_output_dir))
+            self._git("remote", "set-url", "origin", repo_url, cwd=document_output_dir)
+            if not skip_checkout and commit:
+                self._git("checkout", "--quiet", commit, cwd=document_output_dir)
+
+            filepaths = []
+            for pattern in source.get("patterns", []):
+                for file_path in glob.glob(
+                    os.path.join(document_output_dir, pattern), recursive=True
+                ):
+                    if os.path.isfile(file_path) and file_path.lower().endswith(
+                        (".md", ".pdf")
+                    ):
+                        filepaths.append(pathlib.Path(file_path))
+            if filepaths:
+                return filepaths
+            raise SystemExit("Couldn't find knowledge documents")
+
+        def close(self):
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
     tokenizer_model_path = tokenizer_model.path
     if tokenizer_model_path.startswith("oci://"):
         # Handle where the KFP SDK is <2.12.2.
@@ -271,28 +1758,60 @@ def sdg_op(
             "Missing either repo_url or taxonomy_path, cannot proceed with cloning."
         )
 
-    # Handle retries where the repo is already cloned on the PVC
-    if os.path.exists(taxonomy_path):
-        shutil.rmtree(taxonomy_path)
+    # The later stages of a sharded run continue from the taxonomy checkout of the preprocess stage
+    if stage in ("all", "preprocess"):
+        # Handle retries where the repo is already cloned on the PVC
+        if os.path.exists(taxonomy_path):
+            shutil.rmtree(taxonomy_path)
 
-    # Clone the repository
-    exec_cmd(["git", "clone", "-v", repo_url, taxonomy_path], env=env)
-    print("Taxonomy repo cloned executed successfully!")
-    if repo_branch:
-        exec_cmd(["git", "checkout", repo_branch], cwd=taxonomy_path, env=env)
-    elif repo_pr:
-        # Fetch pull request head
-        exec_cmd(
-            ["git", "fetch", "origin", f"pull/{repo_pr}/head:pr-{repo_pr}"],
-            cwd=taxonomy_path,
-            env=env,
-        )
-        exec_cmd(["git", "checkout", f"pr-{repo_pr}"], cwd=taxonomy_path, env=env)
+        # Set taxonomy_base = "empty" to force all the taxonomy files to be processed
+        # More info at https://github.com/instructlab/sdg/blob/a92b0856307b8f7de9f2faebe701949c9583383f/src/instructlab/sdg/utils/taxonomy.py#L295
+        taxonomy_base = "empty"
+
+        if sparse_checkout and (repo_branch or repo_pr):
+            # Only the changed leaf nodes are present, so diff against their base commit instead
+            taxonomy_base = sparse_checkout_changed_leaves()
+        else:
+            # Clone the repository
+            if cache_path:
+                mirror_path = update_taxonomy_mirror(repo_url, cache_path)
+                # Only objects missing from the mirror are downloaded. --dissociate copies the borrowed
+                # objects so the checkout stays usable where the cache volume is not mounted.
+                exec_cmd(
+                    [
+                        "git",
+                        "clone",
+                        "-v",
+                        "--reference",
+                        mirror_path,
+                        "--dissociate",
+                        repo_url,
+                        taxonomy_path,
+                    ],
+                    env=env,
+                )
+            else:
+                exec_cmd(["git", "clone", "-v", repo_url, taxonomy_path], env=env)
+            print("Taxonomy repo cloned executed successfully!")
+            if repo_branch:
+                exec_cmd(["git", "checkout", repo_branch], cwd=taxonomy_path, env=env)
+            elif repo_pr:
+                # Fetch pull request head
+                exec_cmd(
+                    ["git", "fetch", "origin", f"pull/{repo_pr}/head:pr-{repo_pr}"],
+                    cwd=taxonomy_path,
+                    env=env,
+                )
+                exec_cmd(
+                    ["git", "checkout", f"pr-{repo_pr}"], cwd=taxonomy_path, env=env
+                )
 
     if sdg_secret_name is None:
         api_key = os.getenv("api_key")
         model_name = os.getenv("model_name")
         endpoint = os.getenv("endpoint")
+        requests_per_minute = float(os.getenv("requests_per_minute") or 0)
+        tokens_per_minute = float(os.getenv("tokens_per_minute") or 0)
     else:
         print("SDG Teacher secret specified, fetching...")
         secret = fetch_secret(
@@ -306,6 +1825,13 @@ def sdg_op(
         )
         model_name = base64.b64decode(secret_data.get("model_name", "")).decode()
         endpoint = base64.b64decode(secret_data.get("endpoint", "")).decode()
+        # Optional quota of the teacher model server
+        requests_per_minute = float(
+            base64.b64decode(secret_data.get("requests_per_minute", "")).decode() or 0
+        )
+        tokens_per_minute = float(
+            base64.b64decode(secret_data.get("tokens_per_minute", "")).decode() or 0
+        )
         if not endpoint or not model_name:
             print(
                 f"The SDG secret {sdg_secret_name} requires at least data.model_name and data.endpoint",
@@ -315,6 +1841,10 @@ def sdg_op(
 
         print("SDG Teacher secret data retrieved.")
 
+    # The endpoint can list the replicas of the teacher model server, separated by commas or whitespace
+    teacher_endpoints = [e.rstrip("/") for e in re.split(r"[,\s]+", endpoint) if e]
+    endpoint = teacher_endpoints[0]
+
     # A hack because InstructLab assumes the value for model_name is a valid path and the name of the model.
     tmp_model_path = os.path.join(tempfile.gettempdir(), model_name)
     # Since a model name can have a slash in it and InstructLab expects this to be a valid path as well, we must
@@ -324,42 +1854,658 @@ def sdg_op(
     os.symlink(tokenizer_model_path, tmp_model_path)
     os.chdir(tempfile.gettempdir())
 
-    # Use the default SSL context since it leverages OpenSSL to use the correct CA bundle.
-    http_client = httpx.Client(verify=ssl.create_default_context())
-    client = openai.OpenAI(base_url=endpoint, api_key=api_key, http_client=http_client)
+    # Time the blocks of the SDG pipelines and let the teacher requests know which block sent them
+    block_context = threading.local()
+    block_times = collections.defaultdict(float)
+    block_times_lock = threading.Lock()
 
-    # Set taxonomy_base = "empty" to force all the taxonomy files to be processed
-    # More info at https://github.com/instructlab/sdg/blob/a92b0856307b8f7de9f2faebe701949c9583383f/src/instructlab/sdg/utils/taxonomy.py#L295
-    taxonomy_base = "empty"
+    def instrument_block(block_class):
+        generate = block_class.generate
 
-    print("Generating synthetic dataset for:")
-    print()
-    print(
-        instructlab.sdg.utils.taxonomy.read_taxonomy(
-            taxonomy_path, taxonomy_base, document_output_dir=f"{sdg_path}/documents"
+        def timed_generate(self, *args, **kwargs):
+            # Blocks calling the generate method of their parent class are only timed once
+            if getattr(block_context, "name", None) is not None:
+                return generate(self, *args, **kwargs)
+            block_context.name = self.block_name
+            start = time.monotonic()
+            try:
+                return generate(self, *args, **kwargs)
+            finally:
+                block_context.name = None
+                with block_times_lock:
+                    block_times[self.block_name] += time.monotonic() - start
+
+        block_class.generate = timed_generate
+
+    for block_class in set(BlockRegistry.get_registry().values()):
+        if "generate" in vars(block_class):
+            instrument_block(block_class)
+
+    def summarize_requests(requests):
+        latencies = sorted(r["latency"] for r in requests if not r["error"])
+
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[round(p / 100 * (len(latencies) - 1))]
+
+        summary = {
+            "requests": len(requests),
+            "errors": sum(r["error"] for r in requests),
+            "retries": sum(r["retry"] for r in requests),
+            "prompt_tokens": sum(r["prompt_tokens"] for r in requests),
+            "completion_tokens": sum(r["completion_tokens"] for r in requests),
+            # Time spent waiting for the quota of the teacher model server versus waiting on its responses
+            "throttled_time": sum(r["throttled_time"] for r in requests),
+            "server_time": sum(r["latency"] for r in requests),
+            "latency_p50": percentile(50),
+            "latency_p95": percentile(95),
+            "latency_p99": percentile(99),
+        }
+        if prefix_ordering:
+            # Share of the prompts that a model of the prefix cache of the teacher model server could reuse, the
+            # server doesn't report its actual cache hits
+            summary["modelled_prefix_sharing_ratio"] = sum(
+                r["shared_prefix_chars"] for r in requests
+            ) / max(sum(r["prompt_chars"] for r in requests), 1)
+        return summary
+
+    pooled_transport = PooledTransport(http_pool_size, http_keepalive_expiry, http2)
+    teacher_router = EndpointRouterTransport(pooled_transport, teacher_endpoints)
+    teacher_metrics = TeacherMetricsTransport(teacher_router)
+    transport = teacher_metrics
+    hedging = None
+    if hedge_requests:
+        hedging = HedgingTransport(
+            transport, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_MAX_FRACTION
         )
+        transport = hedging
+    if prefix_ordering:
+        transport = PrefixOrderingTransport(transport)
+    adaptive_limiter = None
+    if adaptive_concurrency:
+        # sdg_num_cpus is the starting point, the thread pool of the SDG pipeline only provides the headroom
+        adaptive_limiter = AdaptiveConcurrencyTransport(
+            transport,
+            initial_limit=sdg_num_cpus or 2,
+            max_limit=ADAPTIVE_MAX_WORKERS,
+            latency_tolerance=ADAPTIVE_LATENCY_TOLERANCE,
+        )
+        transport = adaptive_limiter
+    # Throttled requests don't take a slot of the concurrency limit
+    rate_limiter = None
+    if requests_per_minute > 0 or tokens_per_minute > 0:
+        # The shards of a sharded run share the quota
+        num_shards = 1
+        if stage == "generate":
+            with open(
+                os.path.join(sdg_path, "sdg_shard_plan.json"), encoding="utf-8"
+            ) as f:
+                num_shards = len(json.load(f)["shards"])
+        requests_per_minute /= num_shards
+        tokens_per_minute /= num_shards
+        print(
+            f"Limiting teacher requests to {requests_per_minute or 'unlimited'} requests and "
+            f"{tokens_per_minute or 'unlimited'} tokens per minute"
+        )
+        rate_limiter = RateLimitTransport(
+            transport, requests_per_minute, tokens_per_minute
+        )
+        transport = rate_limiter
+    # The quota wait counts against the budget of a leaf node, cache hits don't
+    leaf_guard = None
+    if leaf_timeout_minutes > 0 or leaf_max_failures > 0:
+        leaf_guard = LeafGuardTransport(
+            transport, leaf_timeout_minutes * 60, leaf_max_failures
+        )
+        transport = leaf_guard
+    # Cache hits are served without taking a slot of the concurrency limit
+    teacher_cache = None
+    if teacher_cache_size_gb > 0:
+        print(
+            f"Caching teacher responses in {teacher_cache_path} (up to {teacher_cache_size_gb}GB)"
+        )
+        teacher_cache = TeacherCacheTransport(
+            transport, teacher_cache_path, teacher_cache_size_gb * 1024**3
+        )
+        transport = teacher_cache
+    http_client = httpx.Client(
+        transport=transport,
+        timeout=httpx.Timeout(http_read_timeout, connect=http_connect_timeout),
     )
+    client = openai.OpenAI(base_url=endpoint, api_key=api_key, http_client=http_client)
+
+    # Knowledge documents are converted while preprocessing the taxonomy, reuse the conversions of earlier runs
+    document_cache = None
+    if document_cache_size_gb > 0 and stage in ("all", "preprocess"):
+        if cache_path:
+            document_cache_dir = os.path.join(cache_path, "documents")
+            print(
+                f"Caching document conversions in {document_cache_dir} (up to {document_cache_size_gb}GB)"
+            )
+            document_cache = DocumentCacheConverter(
+                document_cache_dir, document_cache_size_gb * 1024**3
+            )
+            init_docling_converter = DocumentChunker._init_docling_converter
+
+            # A chunker and its converter are created for each knowledge leaf node, one after the other
+            def cached_docling_converter(chunker):
+                document_cache.converter = init_docling_converter(chunker)
+                return document_cache
+
+            DocumentChunker._init_docling_converter = cached_docling_converter
+        else:
+            print("Caching document conversions requires a cache path, skipping")
+
+    def chunk_documents(chunker):
+        """Converts the documents of a knowledge leaf node and chunks them on all CPUs of the pod.
+
+        The chunks are packed up to chunk_tokens tokens of the teacher tokenizer.
+        """
+        from docling_core.transforms.chunker.hybrid_chunker import HybridChunker
+
+        results = list(chunker.converter.convert_all(chunker.document_paths))
+        if chunking_pool and len(results) > 1:
+            return chunking_pool.chunk(
+                [(result.input.file, result.document) for result in results],
+                chunker.tokenizer,
+                chunk_tokens,
+            )
+
+        hybrid_chunker = HybridChunker(
+            tokenizer=chunker.tokenizer, max_tokens=chunk_tokens
+        )
+        chunks = []
+        for result in results:
+            try:
+                chunks.extend(
+                    hybrid_chunker.serialize(chunk=chunk)
+                    for chunk in hybrid_chunker.chunk(dl_doc=result.document)
+                )
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                print(f"Error chunking document {result.input.file}: {e}")
+        return chunks
+
+    # Chunks of the same size as instructlab-sdg, unless they are set or sized to the probed context window of the
+    # teacher model. sdg_estimate_op sizes the chunks the same way.
+    teacher_context_window = server_ctx_size or DEFAULT_TEACHER_CONTEXT_WINDOW
+    chunk_tokens = DEFAULT_CHUNK_TOKENS
+    if server_ctx_size > 0:
+        chunk_tokens = max(
+            server_ctx_size - CHUNK_PROMPT_TOKENS - CHUNK_COMPLETION_TOKENS,
+            256,
+        )
+    if chunk_max_tokens > 0:
+        chunk_tokens = (
+            min(chunk_tokens, chunk_max_tokens)
+            if server_ctx_size > 0
+            else chunk_max_tokens
+        )
+    if stage in ("all", "preprocess"):
+        print(
+            f"Chunking knowledge documents into up to {chunk_tokens} tokens for a teacher context window of "
+            f"{teacher_context_window} tokens"
+        )
+        DocumentChunker.chunk_documents = chunk_documents
+
+    document_fetcher = None
+    if stage in ("all", "preprocess"):
+        # The taxonomy is read twice and leaf nodes often share a document repository, fetch each repository
+        # once and all of them in parallel
+        if cache_path:
+            document_mirrors_dir = os.path.join(cache_path, "document_repos")
+        else:
+            document_mirrors_dir = tempfile.mkdtemp(prefix="document_repos_")
+        document_fetcher = DocumentRepoFetcher(
+            document_mirrors_dir, DOCUMENT_FETCH_WORKERS
+        )
+        if taxonomy_base == "empty":
+            taxonomy_files = instructlab.sdg.utils.taxonomy._get_taxonomy(taxonomy_path)
+        else:
+            taxonomy_files = instructlab.sdg.utils.taxonomy._get_taxonomy_diff(
+                taxonomy_path, taxonomy_base
+            )
+        document_sources = []
+        for taxonomy_file in taxonomy_files:
+            try:
+                with open(
+                    os.path.join(taxonomy_path, taxonomy_file), encoding="utf-8"
+                ) as f:
+                    document_source = (yaml.safe_load(f) or {}).get("document")
+            except (OSError, yaml.YAMLError, AttributeError):
+                # Reported when the taxonomy is read
+                continue
+            if isinstance(document_source, dict) and document_source.get("repo"):
+                document_sources.append(document_source)
+        print(
+            f"Fetching {len({(d['repo'], d.get('commit')) for d in document_sources})} document repositories "
+            f"of {len(document_sources)} knowledge leaf nodes"
+        )
+        document_fetcher.prefetch(document_sources)
+        instructlab.sdg.utils.taxonomy._get_documents = document_fetcher.get_documents
+
+        print("Generating synthetic dataset for:")
+        print()
+        print(
+            instructlab.sdg.utils.taxonomy.read_taxonomy(
+                taxonomy_path,
+                taxonomy_base,
+                document_output_dir=f"{sdg_path}/documents",
+            )
+        )
+
+    sdg_start = time.time()
+    stage_times = {}
+    leaf_node_metrics = {}
+    quarantined_leaf_nodes = {}
+
+    journal_file = os.path.join(sdg_path, "sdg_journal.jsonl")
+
+    def read_journal():
+        """Returns the journal entries of the last SDG run recorded in sdg_path."""
+        entries = []
+        if not os.path.exists(journal_file):
+            return entries
+        with open(journal_file, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A partially written line from a preempted pod
+                    continue
+                if entry["event"] == "start":
+                    entries = []
+                entries.append(entry)
+        return entries
+
+    def append_journal(event, **kwargs):
+        with open(journal_file, "a", encoding="utf-8") as f:
+            # The shards of a sharded run append to the same journal
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps({"event": event, "time": time.time(), **kwargs}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def generate_synthetic_data():
+        """Generates the synthetic dataset one taxonomy leaf node at a time.
+
+        This runs the same stages as instructlab.sdg.generate_data, but calls the teacher model per leaf node
+        so that in incremental mode the output of unchanged leaf nodes is reused from the cache. Progress is
+        journaled to sdg_path so that a retried or preempted run skips the stages and leaf nodes it already
+        completed, and sdg checkpoints the batches of the leaf node that was in progress.
+        """
+        generate_start = time.time()
+
+        # Everything besides the leaf node samples that determines the generated data
+        config_hash = hashlib.sha256()
+        config_hash.update(
+            "\0".join(
+                [
+                    importlib.metadata.version("instructlab-sdg"),
+                    pipeline,
+                    model_name,
+                    # Selects the prompt templates of the teacher model
+                    model_family,
+                    str(num_instructions_to_generate),
+                ]
+            ).encode()
+        )
+        if os.path.isdir(pipeline):
+            for pipeline_file in sorted(glob.glob(os.path.join(pipeline, "*.yaml"))):
+                with open(pipeline_file, "rb") as f:
+                    config_hash.update(f.read())
+
+        journal = read_journal()
+        if stage in ("generate", "merge"):
+            # The later stages of a sharded run continue the run of the preprocess stage
+            if not any(entry["event"] == "preprocessed" for entry in journal):
+                raise RuntimeError(
+                    f"The SDG {stage} stage requires a preprocessed run in {sdg_path}"
+                )
+            run_key = journal[0]["run_key"]
+        else:
+            run_hash = config_hash.copy()
+            run_hash.update(
+                "\0".join(
+                    [
+                        taxonomy_base,
+                        exec_cmd(
+                            ["git", "-C", taxonomy_path, "rev-parse", "HEAD"]
+                        ).strip(),
+                        str(sdg_sampling_size),
+                        str(chunk_tokens),
+                    ]
+                ).encode()
+            )
+            run_key = run_hash.hexdigest()
+
+        if journal and journal[0]["run_key"] == run_key:
+            if journal[-1]["event"] == "complete":
+                print(
+                    "The synthetic dataset was already generated, see the SDG journal"
+                )
+                return
+            date_suffix = journal[0]["date_suffix"]
+            print(f"Resuming the SDG run {date_suffix} from the journal")
+        else:
+            if journal and journal[-1]["event"] != "complete":
+                # Remove the output of an unrelated unfinished run so that it isn't mixed with this one downstream
+                for stale_path in glob.glob(
+                    os.path.join(sdg_path, f"*{journal[0]['date_suffix']}*")
+                ):
+                    print(f"Removing {stale_path} of an unfinished SDG run")
+                    if os.path.isdir(stale_path):
+                        shutil.rmtree(stale_path)
+                    else:
+                        os.remove(stale_path)
+            journal = []
+            date_suffix = (
+                datetime.now().replace(microsecond=0).isoformat().replace(":", "_")
+            )
+            append_journal(
+                "start",
+                run_key=run_key,
+                date_suffix=date_suffix,
+                taxonomy_base=taxonomy_base,
+            )
+        journaled_leaf_nodes = {
+            entry["leaf_node"]: entry for entry in journal if entry["event"] == "leaf"
+        }
+        # Includes the leaf nodes quarantined by the other shards of a sharded run
+        quarantined_leaf_nodes.update(
+            {
+                entry["leaf_node"]: entry["reason"]
+                for entry in journal
+                if entry["event"] == "quarantined"
+            }
+        )
+
+        preprocessed_dir = os.path.join(sdg_path, f"preprocessed_{date_suffix}")
+        generated_dir = os.path.join(sdg_path, f"generated_{date_suffix}")
+        node_datasets_dir = os.path.join(sdg_path, f"node_datasets_{date_suffix}")
+        checkpoint_dir = os.path.join(sdg_path, f"checkpoints_{date_suffix}")
+        os.makedirs(generated_dir, exist_ok=True)
+        os.makedirs(node_datasets_dir, exist_ok=True)
+        # Same as generate_data, a batch size of 0 disables batching
+        batch_size = sdg_batch_size if sdg_batch_size is not None else 0
+        num_cpus = sdg_num_cpus
+        if adaptive_limiter:
+            # The in-flight requests are limited by the transport, so give the thread pool enough workers.
+            # Batching is required for concurrent requests.
+            batch_size = batch_size or 8
+            num_cpus = ADAPTIVE_MAX_WORKERS
+
+        if any(entry["event"] == "preprocessed" for entry in journal):
+            print(f"Reusing the preprocessed taxonomy in {preprocessed_dir}")
+        else:
+            preprocess_taxonomy(
+                taxonomy_path,
+                output_dir=preprocessed_dir,
+                chunk_word_count=1000,
+                server_ctx_size=teacher_context_window,
+                taxonomy_base=taxonomy_base,
+                teacher_model_path=model_name,
+                test_output_file=os.path.join(sdg_path, f"test_{date_suffix}.jsonl"),
+                system_prompt=_SYS_PROMPT,
+            )
+            append_journal("preprocessed")
+        stage_times["preprocess"] = time.time() - generate_start
+        if stage == "preprocess":
+            return
+
+        leaf_cache = None
+        if incremental:
+            if cache_path:
+                leaf_cache = LRUCacheDir(
+                    os.path.join(cache_path, "sdg"),
+                    incremental_cache_size_gb * 1024**3,
+                )
+            else:
+                print(
+                    "Incremental SDG requires a cache path, regenerating all leaf nodes"
+                )
+
+        resumed_leaf_nodes = []
+        reused_leaf_nodes = []
+        generated_leaf_nodes = []
+        samples_files = sorted(glob.glob(os.path.join(preprocessed_dir, "*.jsonl")))
+        if stage == "generate":
+            with open(
+                os.path.join(sdg_path, "sdg_shard_plan.json"), encoding="utf-8"
+            ) as f:
+                shard_plan = json.load(f)
+            if shard_plan["date_suffix"] != date_suffix:
+                raise RuntimeError(
+                    f"The SDG shard plan is for the run {shard_plan['date_suffix']}, not {date_suffix}"
+                )
+            shard_leaf_nodes = set(shard_plan["shards"][shard_index])
+            print(f"Shard {shard_index} has {len(shard_leaf_nodes)} leaf nodes")
+            samples_files = [
+                f
+                for f in samples_files
+                if os.path.basename(f)[: -len(".jsonl")] in shard_leaf_nodes
+            ]
+        # The merge stage skips the leaf nodes journaled by the shards and generates the rest, all of them when
+        # the run isn't sharded
+        for samples_file in samples_files:
+            leaf_node_path = os.path.basename(samples_file)[: -len(".jsonl")]
+            # The samples hold the seed examples of the qna.yaml and the chunks of its documents
+            leaf_hash = config_hash.copy()
+            with open(samples_file, "rb") as f:
+                leaf_hash.update(f.read())
+
+            mmlubench_file = os.path.join(
+                node_datasets_dir, f"mmlubench_{leaf_node_path}.jsonl"
+            )
+            leaf_output_files = [
+                (
+                    os.path.join(generated_dir, f"{leaf_node_path}.jsonl"),
+                    "generated.jsonl",
+                ),
+                (mmlubench_file, "mmlubench.jsonl"),
+                (
+                    os.path.join(node_datasets_dir, f"{leaf_node_path}_task.yaml"),
+                    "task.yaml",
+                ),
+            ]
+
+            journaled_leaf_node = journaled_leaf_nodes.get(leaf_node_path)
+            if (
+                journaled_leaf_node
+                and journaled_leaf_node["hash"] == leaf_hash.hexdigest()
+                and all(os.path.exists(f) for f in journaled_leaf_node["files"])
+            ):
+                print(f"Skipping {leaf_node_path}, it was already completed")
+                resumed_leaf_nodes.append(leaf_node_path)
+                continue
+            if leaf_node_path in quarantined_leaf_nodes:
+                print(
+                    f"Skipping {leaf_node_path}, it was already quarantined: "
+                    f"{quarantined_leaf_nodes[leaf_node_path]}"
+                )
+                continue
+
+            leaf_cache_key = f"{leaf_hash.hexdigest()}.json"
+            cached_leaf = leaf_cache.get(leaf_cache_key) if leaf_cache else None
+            if cached_leaf is not None:
+                print(f"Reusing the cached synthetic data for {leaf_node_path}")
+                cached_files = json.loads(cached_leaf)
+                for output_file, cached_name in leaf_output_files:
+                    if cached_name not in cached_files:
+                        continue
+                    if cached_name == "task.yaml":
+                        # The task points to the MMLU bench data of the run that cached it
+                        task = yaml.safe_load(cached_files[cached_name])
+                        task["dataset_kwargs"]["data_files"]["test"] = mmlubench_file
+                        with open(output_file, "w", encoding="utf-8") as f:
+                            yaml.dump(task, f, default_flow_style=False)
+                    else:
+                        with open(output_file, "w", encoding="utf-8") as f:
+                            f.write(cached_files[cached_name])
+                reused_leaf_nodes.append(leaf_node_path)
+                append_journal(
+                    "leaf",
+                    leaf_node=leaf_node_path,
+                    hash=leaf_hash.hexdigest(),
+                    files=[f for f, _ in leaf_output_files if os.path.exists(f)],
+                )
+                continue
+
+            print(f"Generating synthetic data for {leaf_node_path}")
+            leaf_start = time.time()
+            leaf_first_request = len(teacher_metrics.requests)
+            congestion_events = (
+                adaptive_limiter.congestion_events if adaptive_limiter else 0
+            )
+            if leaf_guard:
+                leaf_guard.start_leaf()
+            try:
+                with tempfile.TemporaryDirectory() as leaf_input_dir:
+                    # Both generate_taxonomy functions process every samples file in their input directory
+                    shutil.copy(samples_file, leaf_input_dir)
+                    generate_taxonomy(
+                        client,
+                        input_dir=leaf_input_dir,
+                        output_dir=generated_dir,
+                        model_family=model_family,
+                        model_id=model_name,
+                        num_cpus=num_cpus,
+                        num_instructions_to_generate=num_instructions_to_generate,
+                        pipeline=pipeline,
+                        batch_size=batch_size,
+                        checkpoint_dir=checkpoint_dir,
+                    )
+                    generate_taxonomy_eval(
+                        client=client,
+                        input_dir=leaf_input_dir,
+                        output_dir=sdg_path,
+                        date_suffix=date_suffix,
+                        model_family=model_family,
+                        model_id=model_name,
+                        num_cpus=num_cpus,
+                        num_instructions_to_generate=num_instructions_to_generate,
+                        batch_size=batch_size,
+                    )
+            except Exception as e:
+                if not (leaf_guard and leaf_guard.reason):
+                    raise
+                # Go on with the remaining leaf nodes, the partial output of this one is not mixed downstream
+                print(f"Quarantining {leaf_node_path}, {leaf_guard.reason}: {e}")
+                quarantined_leaf_nodes[leaf_node_path] = leaf_guard.reason
+                leaf_node_metrics[leaf_node_path] = {
+                    "wall_time": time.time() - leaf_start,
+                    "quarantined": leaf_guard.reason,
+                    **summarize_requests(teacher_metrics.requests[leaf_first_request:]),
+                }
+                for output_file, _ in leaf_output_files:
+                    if os.path.exists(output_file):
+                        os.remove(output_file)
+                shutil.rmtree(
+                    os.path.join(checkpoint_dir, leaf_node_path), ignore_errors=True
+                )
+                append_journal(
+                    "quarantined", leaf_node=leaf_node_path, reason=leaf_guard.reason
+                )
+                continue
+            finally:
+                if leaf_guard:
+                    leaf_guard.end_leaf()
+            generated_leaf_nodes.append(leaf_node_path)
+            leaf_node_metrics[leaf_node_path] = {
+                "wall_time": time.time() - leaf_start,
+                **summarize_requests(teacher_metrics.requests[leaf_first_request:]),
+            }
+            if adaptive_limiter:
+                # The batch size only takes effect per leaf node. Halve it when the teacher was congested even
+                # with a single request in flight, grow it when the in-flight limit can't grow any further.
+                if (
+                    adaptive_limiter.congestion_events > congestion_events
+                    and adaptive_limiter.limit < 2
+                ):
+                    batch_size = max(1, batch_size // 2)
+                elif (
+                    adaptive_limiter.congestion_events == congestion_events
+                    and adaptive_limiter.limit >= ADAPTIVE_MAX_WORKERS
+                ):
+                    batch_size = min(
+                        ADAPTIVE_MAX_BATCH_SIZE, batch_size + (sdg_batch_size or 8)
+                    )
+                print(
+                    f"Adaptive concurrency: {int(adaptive_limiter.limit)} requests in flight, batch size "
+                    f"{batch_size}, {adaptive_limiter.congestion_events} congestion events so far"
+                )
+            append_journal(
+                "leaf",
+                leaf_node=leaf_node_path,
+                hash=leaf_hash.hexdigest(),
+                files=[f for f, _ in leaf_output_files if os.path.exists(f)],
+            )
+            shutil.rmtree(
+                os.path.join(checkpoint_dir, leaf_node_path), ignore_errors=True
+            )
+
+            if leaf_cache:
+                # The output files of a leaf node are cached and evicted together
+                cached_files = {}
+                for output_file, cached_name in leaf_output_files:
+                    if os.path.exists(output_file):
+                        with open(output_file, encoding="utf-8") as f:
+                            cached_files[cached_name] = f.read()
+                leaf_cache.put(leaf_cache_key, json.dumps(cached_files).encode())
+
+        print(
+            f"Resumed {len(resumed_leaf_nodes)}, reused {len(reused_leaf_nodes)} and generated "
+            f"{len(generated_leaf_nodes)} leaf nodes"
+        )
+        if leaf_cache and leaf_cache.evictions:
+            print(
+                f"Evicted {leaf_cache.evictions} leaf nodes from the incremental SDG cache"
+            )
+        if quarantined_leaf_nodes:
+            print(f"Skipped {len(quarantined_leaf_nodes)} quarantined leaf nodes:")
+            for leaf_node_path, reason in sorted(quarantined_leaf_nodes.items()):
+                print(f"  {leaf_node_path}: {reason}")
+        stage_times["generate"] = sum(
+            m["wall_time"] for m in leaf_node_metrics.values()
+        )
+        if stage == "generate":
+            return
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        mix_start = time.time()
+
+        postprocess_taxonomy(
+            input_dir=generated_dir,
+            output_dir=sdg_path,
+            date_suffix=date_suffix,
+            pipeline=pipeline,
+            system_prompt=_SYS_PROMPT,
+        )
+        mix_datasets(
+            recipe_file=os.path.join(sdg_path, f"skills_recipe_{date_suffix}.yaml"),
+            output_file=os.path.join(
+                sdg_path, f"skills_train_msgs_{date_suffix}.jsonl"
+            ),
+            system_prompt=_SYS_PROMPT,
+        )
+        mix_datasets(
+            recipe_file=os.path.join(sdg_path, f"knowledge_recipe_{date_suffix}.yaml"),
+            output_file=os.path.join(
+                sdg_path, f"knowledge_train_msgs_{date_suffix}.jsonl"
+            ),
+            system_prompt=_SYS_PROMPT,
+        )
+
+        stage_times["postprocess_and_mix"] = time.time() - mix_start
+        append_journal("complete")
+        print(f"Generation took {time.time() - generate_start:.2f}s")
 
     # Generate synthetic dataset
     # 1.0 is the default size
     if sdg_sampling_size == 1.0:
-        # generate_data has a magic word for its taxonomy_base argument - 'empty'
+        # preprocess_taxonomy has a magic word for its taxonomy_base argument - 'empty'
         # it allows generating from the whole repo, see:
         # https://github.com/instructlab/sdg/blob/c6a9e74a1618b1077cd38e713b8aaed8b7c0c8ce/src/instructlab/sdg/utils/taxonomy.py#L230
-        instructlab.sdg.generate_data(
-            client=client,
-            num_instructions_to_generate=num_instructions_to_generate,
-            output_dir=sdg_path,
-            taxonomy=taxonomy_path,
-            taxonomy_base=taxonomy_base,
-            model_name=model_name,
-            model_family="mixtral",
-            pipeline=pipeline,
-            chunk_word_count=1000,
-            server_ctx_size=4096,
-            batch_size=sdg_batch_size,
-            num_cpus=sdg_num_cpus,
-        )
+        generate_synthetic_data()
     # Tweak precomputed skills data ratio if needed
     else:
         skills_recipe = "/usr/share/instructlab/sdg/default_data_recipes/skills.yaml"
@@ -444,27 +2590,96 @@ def sdg_op(
                         f"Successfully set precomputed skills data ratio to {sdg_sampling_size}"
                     )
 
-                    # generate_data has a magic word for its taxonomy_base argument - 'empty'
+                    # preprocess_taxonomy has a magic word for its taxonomy_base argument - 'empty'
                     # it allows generating from the whole repo, see:
                     # https://github.com/instructlab/sdg/blob/c6a9e74a1618b1077cd38e713b8aaed8b7c0c8ce/src/instructlab/sdg/utils/taxonomy.py#L230
-                    instructlab.sdg.generate_data(
-                        client=client,
-                        num_instructions_to_generate=num_instructions_to_generate,
-                        output_dir=sdg_path,
-                        taxonomy=taxonomy_path,
-                        taxonomy_base=taxonomy_base,
-                        model_name=model_name,
-                        model_family="mixtral",
-                        pipeline=pipeline,
-                        chunk_word_count=1000,
-                        server_ctx_size=4096,
-                        batch_size=sdg_batch_size,
-                        num_cpus=sdg_num_cpus,
-                    )
+                    generate_synthetic_data()
                 except Exception as e:
                     print(f"Failed to set precomputed skills data ratio: {e}")
                     raise
 
+    if chunking_pool:
+        chunking_pool.close()
+    teacher_router.print_stats()
+    pooled_transport.print_stats()
+    if document_fetcher:
+        document_fetcher.close()
+        if not cache_path:
+            shutil.rmtree(document_mirrors_dir, ignore_errors=True)
+        print(
+            f"Document repositories: {document_fetcher.hits} served from the mirrors, "
+            f"{document_fetcher.fetches} fetched"
+        )
+
+    wall_time = time.time() - sdg_start
+    teacher_summary = summarize_requests(teacher_metrics.requests)
+    report = {
+        "stage": stage,
+        "shard_index": shard_index,
+        "wall_time": wall_time,
+        "stage_times": stage_times,
+        # Close to 1 when SDG is bound by the teacher model, low when it is bound by local processing
+        "teacher_busy_fraction": teacher_metrics.busy_time / wall_time,
+        "teacher": teacher_summary,
+        "hedging": {
+            "requests": hedging.requests,
+            "hedged": hedging.hedged,
+            "hedge_rate": hedging.hedged / max(hedging.requests, 1),
+            "hedge_wins": hedging.hedge_wins,
+            # How much sooner the winning duplicates responded than the requests they duplicated
+            "latency_saved": hedging.latency_saved,
+        }
+        if hedging
+        else None,
+        "leaf_nodes": leaf_node_metrics,
+        "quarantined_leaf_nodes": quarantined_leaf_nodes,
+        "blocks": {
+            block_name: {
+                "time": block_time,
+                **summarize_requests(
+                    [r for r in teacher_metrics.requests if r["block"] == block_name]
+                ),
+            }
+            for block_name, block_time in sorted(block_times.items())
+        },
+    }
+    with open(metrics_report.path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+
+    metrics.log_metric("sdg_wall_time", round(wall_time, 2))
+    metrics.log_metric(
+        "sdg_teacher_busy_fraction", round(report["teacher_busy_fraction"], 4)
+    )
+    metrics.log_metric(
+        "sdg_leaf_nodes_generated",
+        sum("quarantined" not in m for m in leaf_node_metrics.values()),
+    )
+    metrics.log_metric("sdg_leaf_nodes_quarantined", len(quarantined_leaf_nodes))
+    for name, value in teacher_summary.items():
+        metrics.log_metric(
+            f"sdg_teacher_{name}",
+            round(value, 4) if isinstance(value, float) else value,
+        )
+    if hedging:
+        metrics.log_metric("sdg_hedge_rate", round(report["hedging"]["hedge_rate"], 4))
+        metrics.log_metric("sdg_hedge_wins", hedging.hedge_wins)
+        metrics.log_metric("sdg_hedge_latency_saved", round(hedging.latency_saved, 2))
+    if teacher_summary["completion_tokens"] and stage_times.get("generate"):
+        metrics.log_metric(
+            "sdg_completion_tokens_per_second",
+            round(teacher_summary["completion_tokens"] / stage_times["generate"], 2),
+        )
+    if teacher_cache:
+        print(
+            f"Teacher response cache: {teacher_cache.cache.hits} hits, {teacher_cache.cache.misses} misses, "
+            f"{teacher_cache.cache.evictions} evictions"
+        )
+    if document_cache:
+        print(
+            f"Document conversion cache: {document_cache.cache.hits} hits, {document_cache.cache.misses} misses, "
+            f"{document_cache.cache.evictions} evictions"
+        )
+
     # Cleanup git configurations
     if git_credentials_path and os.path.exists(git_credentials_path):
         os.remove(git_credentials_path)
@@ -474,6 +2689,560 @@ def sdg_op(
         print(f"{ssh_key_path} deleted successfully")
 
 
+@dsl.component(base_image=RHELAI_IMAGE, install_kfp_package=False)
+def sdg_estimate_op(
+    num_instructions_to_generate: int,
+    pipeline: str,
+    tokenizer_model: dsl.Input[dsl.Model],
+    metrics: dsl.Output[dsl.Metrics],
+    estimate: dsl.Output[dsl.Artifact],
+    teacher_tokens_per_second: float = 1000.0,
+    max_teacher_hours: float = 0.0,
+    avg_completion_tokens: int = 256,
+    sdg_batch_size: int = None,
+    sdg_path: str = "/data/sdg",
+):
+    import glob
+    import json
+    import math
+    import os
+
+    import instructlab.sdg
+    import xdg_base_dirs
+    import yaml
+    from transformers import AutoTokenizer
+
+    # The text fields of the samples written by preprocess_taxonomy, which fill the prompt templates
+    KNOWLEDGE_SAMPLE_FIELDS = [
+        "document",
+        "icl_document",
+        "icl_query_1",
+        "icl_response_1",
+        "icl_query_2",
+        "icl_response_2",
+        "icl_query_3",
+        "icl_response_3",
+    ]
+    SKILL_SAMPLE_FIELDS = [
+        "task_description",
+        "seed_context",
+        "seed_question",
+        "seed_response",
+    ]
+
+    def estimate_work():
+        """Estimates the teacher work of the leaf nodes preprocessed by sdg_op."""
+        tokenizer_model_path = tokenizer_model.path
+        if tokenizer_model_path.startswith("oci://"):
+            # Handle where the OCI image is mounted. The tokenizer is in the models directory
+            escaped_uri = tokenizer_model_path[len("oci://") :].replace("/", "_")
+            tokenizer_model_path = os.path.join("/oci", escaped_uri, "models")
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_model_path)
+
+        def count_tokens(text):
+            return len(tokenizer.encode(text or "", add_special_tokens=False))
+
+        # Use the run preprocessed by sdg_op
+        start = None
+        with open(os.path.join(sdg_path, "sdg_journal.jsonl"), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry["event"] == "start":
+                    start = entry
+        if start is None:
+            raise RuntimeError(f"No SDG run was preprocessed in {sdg_path}")
+        preprocessed_dir = os.path.join(
+            sdg_path, f"preprocessed_{start['date_suffix']}"
+        )
+
+        # Resolve the pipeline the same way as instructlab-sdg: user and site data directories, then the bundled
+        # pipelines and finally a path
+        pipeline_dir = None
+        for d in [
+            os.path.join(str(d), "instructlab", "sdg", "pipelines", pipeline)
+            for d in xdg_base_dirs.xdg_data_dirs()
+        ] + [
+            os.path.join(
+                os.path.dirname(instructlab.sdg.__file__), "pipelines", pipeline
+            ),
+            pipeline,
+        ]:
+            if os.path.isdir(d):
+                pipeline_dir = d
+                break
+        if pipeline_dir is None:
+            raise RuntimeError(f"SDG pipeline {pipeline} not found")
+        eval_pipeline_file = os.path.join(
+            os.path.dirname(instructlab.sdg.__file__),
+            "pipelines",
+            "eval",
+            "mmlu_bench.yaml",
+        )
+
+        pipeline_blocks = {}
+
+        def load_blocks(pipeline_file):
+            """Returns the LLM and row multiplying blocks of a pipeline with the tokens of their prompt templates."""
+            if pipeline_file not in pipeline_blocks:
+                with open(pipeline_file, encoding="utf-8") as f:
+                    blocks = yaml.safe_load(f)["blocks"]
+                for block in blocks:
+                    config = block.get("config", {})
+                    if "config_path" in config:
+                        config_path = os.path.join(
+                            os.path.dirname(pipeline_file), config["config_path"]
+                        )
+                        with open(config_path, encoding="utf-8") as f:
+                            prompt_config = yaml.safe_load(f)
+                        block["template_tokens"] = count_tokens(
+                            "\n".join(str(v) for v in prompt_config.values() if v)
+                        )
+                pipeline_blocks[pipeline_file] = blocks
+            return pipeline_blocks[pipeline_file]
+
+        def estimate_pipeline(pipeline_file, num_samples, sample_tokens):
+            """Estimates the prompts, completions and tokens of running a pipeline on the samples of a leaf node.
+
+            Every completion is assumed to become a row of the following blocks and filters are assumed to keep
+            every row, so this is an upper bound of the work.
+            """
+            result = {
+                "prompts": 0,
+                "completions": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+            }
+            rows = num_samples
+            for block in load_blocks(pipeline_file):
+                config = block.get("config", {})
+                if "LLMBlock" in block["type"]:
+                    gen_kwargs = config.get("gen_kwargs", {})
+                    n = gen_kwargs.get("n", 1)
+                    if n == "scaled":
+                        n = num_instructions_to_generate
+                    max_tokens = gen_kwargs.get("max_tokens", avg_completion_tokens)
+                    result["prompts"] += rows
+                    result["completions"] += rows * n
+                    result["prompt_tokens"] += rows * (
+                        block.get("template_tokens", 0) + sample_tokens
+                    )
+                    result["completion_tokens"] += (
+                        rows * n * min(max_tokens, avg_completion_tokens)
+                    )
+                    rows *= n
+                elif block["type"] == "FlattenColumnsBlock":
+                    rows *= len(config.get("var_cols", []))
+            return result
+
+        leaf_node_estimates = {}
+        for samples_file in sorted(
+            glob.glob(os.path.join(preprocessed_dir, "*.jsonl"))
+        ):
+            leaf_node_path = os.path.basename(samples_file)[: -len(".jsonl")]
+            with open(samples_file, encoding="utf-8") as f:
+                samples = [json.loads(line) for line in f if line.strip()]
+            if not samples:
+                continue
+
+            # The samples of a knowledge leaf node pair every document chunk with every seed example
+            leaf_node_type = samples[0].get("leaf_node_type", "freeform_skill")
+            if leaf_node_type == "knowledge":
+                sample_fields = KNOWLEDGE_SAMPLE_FIELDS
+                pipeline_files = [
+                    os.path.join(pipeline_dir, "knowledge.yaml"),
+                    eval_pipeline_file,
+                ]
+                chunks = len({sample.get("document") for sample in samples})
+                leaf_node_estimate = {
+                    "type": leaf_node_type,
+                    "seed_examples": len(samples) // chunks,
+                    "document_chunks": chunks,
+                }
+            else:
+                sample_fields = SKILL_SAMPLE_FIELDS
+                pipeline_files = [
+                    os.path.join(
+                        pipeline_dir,
+                        "grounded_skills.yaml"
+                        if leaf_node_type == "grounded_skill"
+                        else "freeform_skills.yaml",
+                    )
+                ]
+                leaf_node_estimate = {
+                    "type": leaf_node_type,
+                    "seed_examples": len(samples),
+                }
+            sample_tokens = sum(
+                count_tokens(sample.get(field))
+                for sample in samples
+                for field in sample_fields
+            ) // len(samples)
+
+            leaf_node_estimate.update(
+                {
+                    "prompts": 0,
+                    "completions": 0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                }
+            )
+            for pipeline_file in pipeline_files:
+                if not os.path.exists(pipeline_file):
+                    continue
+                for key, value in estimate_pipeline(
+                    pipeline_file, len(samples), sample_tokens
+                ).items():
+                    leaf_node_estimate[key] += value
+            leaf_node_estimates[leaf_node_path] = leaf_node_estimate
+
+        totals = {
+            key: sum(e[key] for e in leaf_node_estimates.values())
+            for key in ["prompts", "completions", "prompt_tokens", "completion_tokens"]
+        }
+        return {
+            "taxonomy_base": start.get("taxonomy_base"),
+            "pipeline": pipeline,
+            "num_instructions_to_generate": num_instructions_to_generate,
+            "teacher_tokens_per_second": teacher_tokens_per_second,
+            "leaf_nodes": len(leaf_node_estimates),
+            "seed_examples": sum(
+                e["seed_examples"] for e in leaf_node_estimates.values()
+            ),
+            "document_chunks": sum(
+                e.get("document_chunks", 0) for e in leaf_node_estimates.values()
+            ),
+            # With batching, the prompts of a block are sent sdg_batch_size at a time
+            "requests": (
+                math.ceil(totals["prompts"] / sdg_batch_size)
+                if sdg_batch_size
+                else totals["prompts"]
+            ),
+            **totals,
+            "teacher_hours": totals["completion_tokens"]
+            / teacher_tokens_per_second
+            / 3600,
+            "leaf_node_estimates": leaf_node_estimates,
+        }
+
+    if max_teacher_hours:
+        report = estimate_work()
+    else:
+        # Without a budget the estimate is only informational and must not fail the run
+        try:
+            report = estimate_work()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print(f"Skipping the SDG estimate, no teacher hours budget is set: {e}")
+            return
+
+    with open(estimate.path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+
+    for key in [
+        "leaf_nodes",
+        "seed_examples",
+        "document_chunks",
+        "requests",
+        "prompt_tokens",
+        "completion_tokens",
+    ]:
+        metrics.log_metric(f"sdg_estimated_{key}", report[key])
+    teacher_hours = report["teacher_hours"]
+    metrics.log_metric("sdg_estimated_teacher_hours", round(teacher_hours, 2))
+
+    print(
+        f"Estimated SDG work for {report['leaf_nodes']} leaf nodes, {report['seed_examples']} seed examples and "
+        f"{report['document_chunks']} document chunks: {report['requests']} requests, {report['prompt_tokens']} "
+        f"prompt tokens, {report['completion_tokens']} completion tokens, {teacher_hours:.2f} hours at "
+        f"{teacher_tokens_per_second} tokens per second"
+    )
+
+    if max_teacher_hours and teacher_hours > max_teacher_hours:
+        raise RuntimeError(
+            f"The estimated {teacher_hours:.2f} teacher hours exceed the budget of {max_teacher_hours} hours, "
+            "reduce sdg_scale_factor or the taxonomy changes"
+        )
+
+
+@dsl.component(base_image=RUNTIME_GENERIC_IMAGE, install_kfp_package=False)
+def sdg_shard_plan_op(num_shards: int, sdg_path: str = "/data/sdg") -> list:
+    import glob
+    import heapq
+    import json
+    import os
+
+    with open(os.path.join(sdg_path, "sdg_journal.jsonl"), encoding="utf-8") as f:
+        journal = []
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry["event"] == "start":
+                journal = []
+            journal.append(entry)
+    date_suffix = journal[0]["date_suffix"]
+    # Leaf nodes completed or quarantined before a retry are not generated again
+    completed_leaf_nodes = {
+        entry["leaf_node"]
+        for entry in journal
+        if entry["event"] in ("leaf", "quarantined")
+    }
+
+    leaf_node_work = []
+    for samples_file in glob.glob(
+        os.path.join(sdg_path, f"preprocessed_{date_suffix}", "*.jsonl")
+    ):
+        leaf_node_path = os.path.basename(samples_file)[: -len(".jsonl")]
+        if leaf_node_path in completed_leaf_nodes:
+            continue
+        with open(samples_file, encoding="utf-8") as f:
+            num_samples = sum(1 for line in f if line.strip())
+        leaf_node_work.append((num_samples, leaf_node_path))
+
+    # The SDG pipeline runs once per sample, so the number of samples estimates the work of a leaf node.
+    # Leaf nodes are assigned longest-processing-time-first, each to the shard with the least work so far.
+    num_shards = max(1, min(num_shards, len(leaf_node_work)))
+    shards = [[] for _ in range(num_shards)]
+    shard_work = [(0, shard) for shard in range(num_shards)]
+    for work, leaf_node_path in sorted(leaf_node_work, reverse=True):
+        total_work, shard = heapq.heappop(shard_work)
+        shards[shard].append(leaf_node_path)
+        heapq.heappush(shard_work, (total_work + work, shard))
+
+    for total_work, shard in sorted(shard_work, key=lambda s: s[1]):
+        print(f"Shard {shard}: {len(shards[shard])} leaf nodes, {total_work} samples")
+
+    with open(
+        os.path.join(sdg_path, "sdg_shard_plan.json"), "w", encoding="utf-8"
+    ) as f:
+        json.dump({"date_suffix": date_suffix, "shards": shards}, f, indent=2)
+
+    return list(range(num_shards))
+
+
+@dsl.component(base_image=RUNTIME_GENERIC_IMAGE, install_kfp_package=False)
+def sdg_shard_check_op(sdg_path: str = "/data/sdg"):
+    import json
+    import os
+
+    with open(os.path.join(sdg_path, "sdg_shard_plan.json"), encoding="utf-8") as f:
+        shard_plan = json.load(f)
+
+    with open(os.path.join(sdg_path, "sdg_journal.jsonl"), encoding="utf-8") as f:
+        completed_leaf_nodes = set()
+        quarantined_leaf_nodes = set()
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry["event"] == "start":
+                completed_leaf_nodes = set()
+                quarantined_leaf_nodes = set()
+            elif entry["event"] == "leaf":
+                completed_leaf_nodes.add(entry["leaf_node"])
+            elif entry["event"] == "quarantined":
+                quarantined_leaf_nodes.add(entry["leaf_node"])
+
+    missing_leaf_nodes = [
+        leaf_node_path
+        for shard in shard_plan["shards"]
+        for leaf_node_path in shard
+        if leaf_node_path not in completed_leaf_nodes | quarantined_leaf_nodes
+    ]
+    if missing_leaf_nodes:
+        raise RuntimeError(
+            f"The SDG shards did not generate the leaf nodes: {', '.join(missing_leaf_nodes)}"
+        )
+
+    if quarantined_leaf_nodes:
+        print(
+            f"The SDG shards quarantined the leaf nodes: {', '.join(sorted(quarantined_leaf_nodes))}"
+        )
+    print(
+        f"All {len(shard_plan['shards'])} SDG shards of the run {shard_plan['date_suffix']} completed"
+    )
+
+
+@dsl.component(base_image=RHELAI_IMAGE, install_kfp_package=False)
+def sdg_dedup_op(
+    metrics: dsl.Output[dsl.Metrics],
+    threshold: float = 0.0,
+    max_memory_mb: int = 1024,
+    sdg_path: str = "/data/sdg",
+):
+    import glob
+    import hashlib
+    import json
+    import math
+    import os
+    import re
+    import zlib
+
+    import numpy as np
+
+    NUM_PERMUTATIONS = 128
+    SHINGLE_WORDS = 5
+    MERSENNE_PRIME = (1 << 61) - 1
+
+    if threshold <= 0:
+        print("Skipping the removal of duplicate SDG samples")
+        return
+
+    # Pick the LSH bands whose similarity threshold, where a pair has a 50% chance of a matching band, is closest
+    rows = min(
+        range(1, NUM_PERMUTATIONS + 1),
+        key=lambda r: abs((1 / (NUM_PERMUTATIONS // r)) ** (1 / r) - threshold),
+    )
+    bands = NUM_PERMUTATIONS // rows
+    print(
+        f"Removing SDG samples with a Jaccard similarity above about {threshold} using {bands} bands of {rows} rows"
+    )
+
+    rng = np.random.default_rng(0)
+    # 32 bit coefficients and shingle hashes keep the permutations within 64 bits
+    perm_a = rng.integers(1, 1 << 32, size=(bands * rows, 1), dtype=np.uint64)
+    perm_b = rng.integers(0, 1 << 32, size=(bands * rows, 1), dtype=np.uint64)
+
+    def sample_text(line):
+        sample = json.loads(line)
+        text = " ".join(
+            f"{message.get('role', '')} {message.get('content', '')}"
+            for message in sample.get("messages", [])
+        )
+        return " ".join(re.findall(r"\w+", text.lower()))
+
+    def minhash(text):
+        words = text.split()
+        shingles = {
+            " ".join(words[i : i + SHINGLE_WORDS])
+            for i in range(max(len(words) - SHINGLE_WORDS + 1, 1))
+        }
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode()) for shingle in shingles),
+            dtype=np.uint64,
+            count=len(shingles),
+        )
+        return ((perm_a * hashes + perm_b) % MERSENNE_PRIME).min(axis=1)
+
+    # Odd multipliers hashing the rows of each band into the two 64 bit hashes of its key
+    band_multipliers = rng.integers(0, 1 << 63, size=(2, rows), dtype=np.uint64) * 2 + 1
+
+    def sample_keys(text, signature):
+        """The keys of a sample as two 64 bit hashes each, the exact text first and then each LSH band."""
+        digest = np.frombuffer(hashlib.sha256(text.encode()).digest()[:16], np.uint64)
+        band_rows = signature.reshape(bands, rows)
+        h1 = (band_rows * band_multipliers[0]).sum(axis=1) + np.arange(
+            1, bands + 1, dtype=np.uint64
+        )
+        h2 = (band_rows * band_multipliers[1]).sum(axis=1)
+        return np.append(digest[0], h1), np.append(digest[1], h2)
+
+    class BloomFilter:
+        """A fixed size set of keys, which can report keys that were never added with a small probability."""
+
+        def __init__(self, num_bits, num_keys):
+            self.num_bits = num_bits
+            self.num_hashes = max(
+                1, min(16, round(num_bits / max(num_keys, 1) * math.log(2)))
+            )
+            self.bits = np.zeros(num_bits // 8 + 1, dtype=np.uint8)
+            self.num_keys = 0
+
+        def _bits(self, h1, h2):
+            hash_index = np.arange(self.num_hashes, dtype=np.uint64)
+            return (h1[:, None] + hash_index * (h2[:, None] | 1)) % np.uint64(
+                self.num_bits
+            )
+
+        def contains(self, h1, h2):
+            bits = self._bits(h1, h2)
+            return ((self.bits[bits >> 3] >> (bits & 7).astype(np.uint8)) & 1).all(
+                axis=1
+            )
+
+        def add(self, h1, h2):
+            bits = self._bits(h1, h2).ravel()
+            np.bitwise_or.at(
+                self.bits, bits >> 3, np.left_shift(1, bits & 7).astype(np.uint8)
+            )
+            self.num_keys += len(h1)
+
+        def false_positive_rate(self):
+            return (
+                1 - math.exp(-self.num_hashes * self.num_keys / self.num_bits)
+            ) ** self.num_hashes
+
+    totals = {"samples": 0, "exact_duplicates": 0, "near_duplicates": 0}
+    false_positive_rate = 0.0
+    # The knowledge and skills datasets are trained in separate phases and deduplicated separately
+    for dataset in ("knowledge", "skills"):
+        files = sorted(
+            glob.glob(os.path.join(sdg_path, f"{dataset}_train_msgs*.jsonl"))
+        )
+        if not files:
+            continue
+        num_samples = 0
+        for file in files:
+            with open(file, "rb") as f:
+                num_samples += sum(1 for _ in f)
+        if not num_samples:
+            # A taxonomy with only skills or only knowledge leaf nodes leaves the other dataset empty
+            print(f"The {dataset} dataset is empty, skipping")
+            continue
+        # Each kept sample adds an exact key and a key per band
+        seen = BloomFilter(max_memory_mb * 8 * 1024**2, num_samples * (bands + 1))
+
+        counts = {"samples": 0, "exact_duplicates": 0, "near_duplicates": 0}
+        for file in files:
+            tmp_file = f"{file}.dedup"
+            with (
+                open(file, encoding="utf-8") as f_in,
+                open(tmp_file, "w", encoding="utf-8") as f_out,
+            ):
+                for line in f_in:
+                    if not line.strip():
+                        continue
+                    counts["samples"] += 1
+                    text = sample_text(line)
+                    h1, h2 = sample_keys(text, minhash(text))
+                    present = seen.contains(h1, h2)
+                    if present[0]:
+                        counts["exact_duplicates"] += 1
+                        continue
+                    if present[1:].any():
+                        counts["near_duplicates"] += 1
+                        continue
+                    # Only the kept samples are compared with the later ones
+                    seen.add(h1, h2)
+                    f_out.write(line if line.endswith("\n") else f"{line}\n")
+            os.replace(tmp_file, file)
+
+        removed = counts["exact_duplicates"] + counts["near_duplicates"]
+        print(
+            f"Removed {removed} of the {counts['samples']} {dataset} samples: {counts['exact_duplicates']} exact "
+            f"and {counts['near_duplicates']} near duplicates"
+        )
+        for name, value in counts.items():
+            totals[name] += value
+            metrics.log_metric(f"sdg_dedup_{dataset}_{name}", value)
+        false_positive_rate = max(false_positive_rate, seen.false_positive_rate())
+
+    for name, value in totals.items():
+        metrics.log_metric(f"sdg_dedup_{name}", value)
+    metrics.log_metric(
+        "sdg_dedup_removed", totals["exact_duplicates"] + totals["near_duplicates"]
+    )
+    # The probability of removing a distinct sample due to the bounded memory
+    metrics.log_metric(
+        "sdg_dedup_false_positive_rate",
+        round(1 - (1 - false_positive_rate) ** (bands + 1), 6),
+    )
+
+
 @dsl.container_component
 def taxonomy_to_artifact_op(
     taxonomy: dsl.Output[dsl.Dataset], pvc_path: str = "/data/taxonomy"
@@ -0,0 +1,21 @@
+"""Loads the helper classes defined inside the component functions, which can't be imported on their own."""
+
+import ast
+import pathlib
+import textwrap
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parents[2]
+
+
+def load_classes(component_file, names, namespace):
+    """Executes the classes of component_file with the given names in namespace and returns them by name."""
+    source = (REPO_ROOT / component_file).read_text(encoding="utf-8")
+    classes = {}
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.ClassDef) and node.name in names:
+            exec(textwrap.dedent(ast.get_source_segment(source, node)), namespace)
+            classes[node.name] = namespace[node.name]
+    missing = set(names) - set(classes)
+    if missing:
+        raise AssertionError(f"{component_file} has no {', '.join(sorted(missing))}")
+    return classes
@@ -0,0 +1,131 @@
+"""Runs the EndpointRouterTransport of the SDG and evaluation components against local stand-in model servers.
+
+The transport is defined inside each component function, so its source is taken from the component modules.
+Run with `python -m pytest tests/components`.
+"""
+
+import http.server
+import json
+import socket
+import threading
+import time
+
+import httpx
+import pytest
+from component_source import load_classes
+
+COMPONENT_FILES = ["sdg/components.py", "eval/final.py", "eval/mt_bench.py"]
+
+
+def load_router_class(component_file):
+    namespace = {"httpx": httpx, "threading": threading, "time": time}
+    return load_classes(component_file, ["EndpointRouterTransport"], namespace)[
+        "EndpointRouterTransport"
+    ]
+
+
+class StandInServer(http.server.ThreadingHTTPServer):
+    """Answers every request with the name of the server and the path it received."""
+
+    def __init__(self, name):
+        self.name = name
+        self.paths = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                self.paths.append(handler.path)
+                body = json.dumps({"server": name, "path": handler.path}).encode()
+                handler.send_response(200)
+                handler.send_header("content-type", "application/json")
+                handler.send_header("content-length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+@pytest.fixture
+def servers():
+    started = [StandInServer("a"), StandInServer("b")]
+    yield started
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.mark.parametrize("component_file", COMPONENT_FILES)
+def test_spreads_requests_over_replicas(component_file, servers):
+    router_class = load_router_class(component_file)
+    endpoints = [f"http://127.0.0.1:{server.port}/v1" for server in servers]
+    router = router_class(httpx.HTTPTransport(), endpoints)
+    with httpx.Client(transport=router) as client:
+        responses = [
+            client.get(f"{endpoints[0]}/models", params={"n": i}).json()
+            for i in range(4)
+        ]
+
+    assert {response["server"] for response in responses} == {"a", "b"}
+    assert [response["path"] for response in responses] == [
+        f"/v1/models?n={i}" for i in range(4)
+    ]
+    assert sum(replica["requests"] for replica in router.replicas.values()) == 4
+
+
+@pytest.mark.parametrize("component_file", COMPONENT_FILES)
+def test_matches_endpoints_written_differently(component_file, servers):
+    router_class = load_router_class(component_file)
+    endpoints = [
+        f"HTTP://LOCALHOST:{servers[0].port}/v1/",
+        f"http://127.0.0.1:{servers[1].port}/v1",
+    ]
+    router = router_class(httpx.HTTPTransport(), endpoints)
+    with httpx.Client(transport=router) as client:
+        for _ in range(2):
+            client.get(f"http://localhost:{servers[0].port}/v1/models")
+
+    assert router.replicas[endpoints[0]]["requests"] == 1
+    assert router.replicas[endpoints[1]]["requests"] == 1
+    assert servers[1].paths == ["/v1/models"]
+
+
+@pytest.mark.parametrize("component_file", COMPONENT_FILES)
+def test_passes_through_other_paths(component_file, servers):
+    router_class = load_router_class(component_file)
+    endpoints = [f"http://127.0.0.1:{server.port}/v1" for server in servers]
+    router = router_class(httpx.HTTPTransport(), endpoints)
+    with httpx.Client(transport=router) as client:
+        # Shares the prefix of the endpoint as a string but is not below its path
+        response = client.get(f"http://127.0.0.1:{servers[0].port}/v10/models")
+
+    assert response.json() == {"server": "a", "path": "/v10/models"}
+    assert servers[1].paths == []
+    assert all(replica["requests"] == 0 for replica in router.replicas.values())
+
+
+@pytest.mark.parametrize("component_file", COMPONENT_FILES)
+def test_fails_over_unreachable_replicas(component_file, servers):
+    router_class = load_router_class(component_file)
+    endpoints = [
+        f"http://127.0.0.1:{unused_port()}/v1",
+        f"http://127.0.0.1:{servers[0].port}/v1",
+    ]
+    router = router_class(httpx.HTTPTransport(), endpoints, max_failures=1)
+    with httpx.Client(transport=router) as client:
+        responses = [client.get(f"{endpoints[0]}/models").json() for _ in range(3)]
+
+    assert [response["server"] for response in responses] == ["a"] * 3
+    assert router.replicas[endpoints[0]]["ejections"] == 1
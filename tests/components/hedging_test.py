@@ -0,0 +1,70 @@
+"""Runs the HedgingTransport of the SDG component above its TeacherMetricsTransport, as sdg_op chains them.
+
+Run with `python -m pytest tests/components`.
+"""
+
+import collections
+import concurrent.futures
+import json
+import threading
+import time
+
+import httpx
+from component_source import load_classes
+
+
+def load_transports():
+    namespace = {
+        "collections": collections,
+        "concurrent": concurrent,
+        "httpx": httpx,
+        "json": json,
+        "threading": threading,
+        "time": time,
+        "ADAPTIVE_MAX_WORKERS": 4,
+        "block_context": threading.local(),
+    }
+    classes = load_classes(
+        "sdg/components.py",
+        ["HedgingTransport", "TeacherMetricsTransport"],
+        namespace,
+    )
+    return classes, namespace["block_context"]
+
+
+def test_records_the_block_of_hedged_requests():
+    classes, block_context = load_transports()
+    slow_requests = {3}
+    num_requests = 0
+    lock = threading.Lock()
+
+    def complete(request):
+        nonlocal num_requests
+        with lock:
+            num_requests += 1
+            slow = num_requests in slow_requests
+        time.sleep(0.5 if slow else 0.01)
+        return httpx.Response(
+            200, json={"usage": {"prompt_tokens": 1, "completion_tokens": 1}}
+        )
+
+    metrics = classes["TeacherMetricsTransport"](httpx.MockTransport(complete))
+    hedging = classes["HedgingTransport"](
+        metrics, percentile=95, min_samples=2, max_fraction=1.0
+    )
+    block_context.name = "gen_knowledge"
+    with httpx.Client(transport=hedging) as client:
+        for _ in range(3):
+            response = client.post(
+                "http://teacher/v1/completions",
+                json={"prompt": "tell me a funny joke.", "max_tokens": 16},
+            )
+            assert response.status_code == 200
+    # The losing copy of the hedged request is recorded once it completes
+    deadline = time.monotonic() + 5
+    while len(metrics.requests) < 4 and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert hedging.hedged == 1
+    assert len(metrics.requests) == 4
+    assert [record["block"] for record in metrics.requests] == ["gen_knowledge"] * 4
@@ -0,0 +1,228 @@
+"""Benchmarks the PooledTransport of the components against a local stand-in OpenAI-compatible server.
+
+Sends concurrent /v1/completions requests through the transport the clients used before, httpx.HTTPTransport
+with the default pool limits, and through PooledTransport, then prints the requests per second and the connections
+the server accepted for each. The server runs in its own process so it doesn't share the GIL with the clients.
+
+Run with `python tests/components/pooled_transport_benchmark.py`, `--tls` serves HTTPS with a self-signed
+certificate made by the openssl command.
+"""
+
+import collections
+import concurrent.futures
+import http.server
+import json
+import multiprocessing
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+import click
+import httpx
+from component_source import load_classes
+
+
+class CompletionsHandler(http.server.BaseHTTPRequestHandler):
+    """Answers every POST with a completion, keeping the connection open like a model server."""
+
+    protocol_version = "HTTP/1.1"
+    # Sends the headers and the body without waiting for the ACK of the headers, like uvicorn
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.connections.get_lock():
+            self.server.connections.value += 1
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["content-length"])))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = json.dumps(
+            {
+                "id": "cmpl-stand-in",
+                "object": "text_completion",
+                "model": request.get("model"),
+                "choices": [
+                    {"index": 0, "text": " a joke.", "finish_reason": "length"}
+                ],
+                "usage": {
+                    "prompt_tokens": 8,
+                    "completion_tokens": request.get("max_tokens", 16),
+                    "total_tokens": 8 + request.get("max_tokens", 16),
+                },
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CompletionsServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # Accepts a connection from every client thread at once
+    request_queue_size = 1024
+
+
+def serve(port, connections, latency, certfile, keyfile):
+    server = CompletionsServer(("127.0.0.1", 0), CompletionsHandler)
+    server.connections = connections
+    server.latency = latency
+    if certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    port.value = server.server_address[1]
+    server.serve_forever()
+
+
+def run(transport, url, concurrency, num_requests):
+    """Sends num_requests completions with concurrency threads.
+
+    Returns the completed requests per second and the number of requests failed with transport errors.
+    """
+
+    def complete(i):
+        try:
+            response = client.post(
+                url,
+                json={
+                    "model": "teacher",
+                    "prompt": f"tell me a funny joke {i}",
+                    "max_tokens": 16,
+                },
+            )
+        except httpx.TransportError:
+            return False
+        response.raise_for_status()
+        return True
+
+    with httpx.Client(transport=transport, timeout=60.0) as client:
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            completed = sum(executor.map(complete, range(num_requests)))
+        return completed / (time.perf_counter() - start), num_requests - completed
+
+
+@click.command()
+@click.option(
+    "--component-file",
+    default="sdg/components.py",
+    show_default=True,
+    type=click.Choice(["sdg/components.py", "eval/final.py", "eval/mt_bench.py"]),
+    help="Component module to take PooledTransport from.",
+)
+@click.option("--concurrency", default=64, show_default=True, help="Client threads.")
+@click.option("--requests", "num_requests", default=5000, show_default=True)
+@click.option(
+    "--pool-size",
+    default=64,
+    show_default=True,
+    help="The http_pool_size component parameter.",
+)
+@click.option(
+    "--latency",
+    default=0.0,
+    show_default=True,
+    help="Seconds the stand-in server takes to answer, like the generation time of a model server.",
+)
+@click.option("--tls", is_flag=True, help="Serve HTTPS with a self-signed certificate.")
+def benchmark(component_file, concurrency, num_requests, pool_size, latency, tls):
+    pooled_transport_class = load_classes(
+        component_file,
+        ["PooledTransport"],
+        {
+            "collections": collections,
+            "httpx": httpx,
+            "ssl": ssl,
+            "threading": threading,
+        },
+    )["PooledTransport"]
+
+    with tempfile.TemporaryDirectory() as cert_dir:
+        certfile = keyfile = None
+        scheme = "http"
+        if tls:
+            certfile = os.path.join(cert_dir, "cert.pem")
+            keyfile = os.path.join(cert_dir, "key.pem")
+            subprocess.run(
+                [
+                    "openssl",
+                    "req",
+                    "-x509",
+                    "-newkey",
+                    "rsa:2048",
+                    "-nodes",
+                    "-days",
+                    "1",
+                    "-subj",
+                    "/CN=127.0.0.1",
+                    "-addext",
+                    "subjectAltName=IP:127.0.0.1",
+                    "-keyout",
+                    keyfile,
+                    "-out",
+                    certfile,
+                ],
+                check=True,
+                capture_output=True,
+            )
+            # Both transports verify with the default SSL context, which trusts SSL_CERT_FILE
+            os.environ["SSL_CERT_FILE"] = certfile
+            scheme = "https"
+
+        port = multiprocessing.Value("i", 0)
+        connections = multiprocessing.Value("i", 0)
+        server = multiprocessing.Process(
+            target=serve,
+            args=(port, connections, latency, certfile, keyfile),
+            daemon=True,
+        )
+        server.start()
+        try:
+            while not port.value:
+                time.sleep(0.01)
+            url = f"{scheme}://127.0.0.1:{port.value}/v1/completions"
+
+            transports = {
+                # The transport of the clients before PooledTransport, with the default httpx pool limits
+                "before": lambda: httpx.HTTPTransport(
+                    verify=ssl.create_default_context()
+                ),
+                "after": lambda: pooled_transport_class(pool_size, 60.0, False),
+            }
+            results = {}
+            for name, make_transport in transports.items():
+                # Warm up the server so both runs start with the same server state
+                run(make_transport(), url, concurrency, concurrency)
+                connections.value = 0
+                requests_per_second, errors = run(
+                    make_transport(), url, concurrency, num_requests
+                )
+                results[name] = (requests_per_second, errors, connections.value)
+        finally:
+            server.terminate()
+            server.join()
+
+    print(
+        f"{num_requests} {scheme.upper()} completions with {concurrency} threads, "
+        f"{latency}s server latency, PooledTransport of {component_file} with a pool of {pool_size}"
+    )
+    for name, (requests_per_second, errors, num_connections) in results.items():
+        print(
+            f"{name:>6}: {requests_per_second:8.1f} req/s, {errors} transport errors, "
+            f"{num_connections} connections accepted"
+        )
+    print(f"speedup: {results['after'][0] / results['before'][0]:.2f}x")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -13,24 +13,221 @@ from utils.consts import PYTHON_IMAGE, RHELAI_IMAGE, TOOLBOX_IMAGE
     install_kfp_package=False,
 )
 def data_processing_op(
+    metrics: dsl.Output[dsl.Metrics],
     model_path: str = "/model",
     sdg_path: str = "/data/sdg",
     skills_path: str = "/data/skills",
     knowledge_path: str = "/data/knowledge",
     max_seq_len: Optional[int] = 4096,
     max_batch_len: Optional[int] = 20000,
+    cache_path: str = None,
+    tokenized_cache_size_gb: int = 0,
+    token_arrays: bool = False,
+    packing_max_batch_len: int = 0,
+    nproc_per_node: int = 1,
+    nnodes: int = 1,
+    target_drop_rate: float = 0.01,
 ):
+    import collections
+    import contextlib
+    import fcntl
+    import glob
+    import hashlib
+    import importlib.metadata
+    import json
+    import multiprocessing
     import os
+    import queue
+    import sys
+    import traceback
+    import uuid
 
     # It tries to write to $HOME/.triton and the home path is not writable by default
     os.environ["HOME"] = "/tmp"
 
     import instructlab.training.data_process as dp
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from datasets import Dataset, concatenate_datasets
     from instructlab.training import (
         DataProcessArgs,
         TrainingArgs,
     )
 
+    # The files of a Hugging Face model which determine how it tokenizes
+    TOKENIZER_FILES = [
+        "tokenizer.json",
+        "tokenizer_config.json",
+        "special_tokens_map.json",
+        "added_tokens.json",
+        "chat_template.jinja",
+        "tokenizer.model",
+        "vocab.json",
+        "vocab.txt",
+        "merges.txt",
+    ]
+
+    # instructlab-training drops the samples shorter than this many tokens besides the ones of max_seq_len or longer
+    MIN_SEQ_LEN = 20
+    # The suggested max_batch_len is the smallest multiple of the suggested max_seq_len that packs the samples with
+    # at most this fraction of the tokens of the batches left unused
+    TARGET_PACKING_WASTE = 0.05
+    MAX_BATCH_LEN_MULTIPLES = [1, 2, 3, 4, 6, 8]
+    LENGTH_HISTOGRAM_BINS = 32
+    TOKENIZED_CACHE_SHARD_SAMPLES = 10000
+
+    class TokenizedSampleCache:
+        """A content-addressed cache of the input_ids and labels of training samples, bounded in size.
+
+        Samples are keyed by their messages, the tokenizer files of the model, the chat template and the
+        instructlab-training version, and stored with their keys in Parquet shards of up to
+        TOKENIZED_CACHE_SHARD_SAMPLES samples. The keys of the shards make up a hash index, so the samples of a
+        dataset are looked up in bulk with every shard read at most once, and the missed samples are tokenized
+        and written as new shards. Least recently used shards are evicted first.
+        """
+
+        def __init__(self, cache_dir, max_size_bytes, model_path, chat_tmpl_path):
+            tokenizer_hash = hashlib.sha256(
+                importlib.metadata.version("instructlab-training").encode()
+            )
+            for tokenizer_file in TOKENIZER_FILES + [chat_tmpl_path]:
+                if not tokenizer_file:
+                    continue
+                tokenizer_hash.update(tokenizer_file.encode())
+                tokenizer_path = os.path.join(model_path, tokenizer_file)
+                if os.path.isfile(tokenizer_path):
+                    with open(tokenizer_path, "rb") as f:
+                        tokenizer_hash.update(f.read())
+            self._tokenizer_key = tokenizer_hash.hexdigest()
+            self._cache_dir = cache_dir
+            self._max_size_bytes = max_size_bytes
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+            os.makedirs(cache_dir, exist_ok=True)
+
+        @contextlib.contextmanager
+        def _locked(self, exclusive):
+            # The datasets are processed in parallel processes sharing the cache
+            with open(os.path.join(self._cache_dir, ".lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        def _shards(self):
+            return glob.glob(os.path.join(self._cache_dir, "*.parquet"))
+
+        def _cache_key(self, sample):
+            return hashlib.sha256(
+                json.dumps(
+                    [
+                        self._tokenizer_key,
+                        sample["messages"],
+                        bool(sample.get("unmask")),
+                    ],
+                    sort_keys=True,
+                ).encode()
+            ).hexdigest()
+
+        def _lookup(self, keys):
+            """Returns the cached samples of the keys by their position in keys."""
+            positions = collections.defaultdict(list)
+            for i, key in enumerate(keys):
+                positions[key].append(i)
+            processed = {}
+            with self._locked(exclusive=False):
+                for shard in self._shards():
+                    if not positions:
+                        break
+                    shard_keys = pq.read_table(shard, columns=["key"])["key"]
+                    rows = [
+                        row
+                        for row, key in enumerate(shard_keys.to_pylist())
+                        if key in positions
+                    ]
+                    if not rows:
+                        continue
+                    for sample in pq.read_table(shard).take(rows).to_pylist():
+                        for i in positions.pop(sample.pop("key"), []):
+                            processed[i] = sample
+                    os.utime(shard)
+            return processed
+
+        def _store(self, samples):
+            """Writes the samples, a dict of their keys to their columns, as new shards and evicts old ones."""
+            samples = [{"key": key, **sample} for key, sample in samples.items()]
+            with self._locked(exclusive=True):
+                for start in range(0, len(samples), TOKENIZED_CACHE_SHARD_SAMPLES):
+                    shard = os.path.join(self._cache_dir, f"{uuid.uuid4().hex}.parquet")
+                    pq.write_table(
+                        pa.Table.from_pylist(
+                            samples[start : start + TOKENIZED_CACHE_SHARD_SAMPLES]
+                        ),
+                        f"{shard}.tmp",
+                    )
+                    os.replace(f"{shard}.tmp", shard)
+
+                shards = sorted(
+                    (os.path.getmtime(shard), os.path.getsize(shard), shard)
+                    for shard in self._shards()
+                )
+                size_bytes = sum(size for _, size, _ in shards)
+                if size_bytes <= self._max_size_bytes:
+                    return
+                target_size = self._max_size_bytes * 0.9
+                for _, size, shard in shards:
+                    if size_bytes <= target_size:
+                        break
+                    os.remove(shard)
+                    size_bytes -= size
+                    self.evictions += 1
+
+        def process_samples(self, data, tokenizer, num_cpu_procs):
+            """Same as instructlab.training.data_process.process_samples, but only processes the missed samples."""
+            keys = [
+                self._cache_key(sample)
+                for sample in data.select_columns(
+                    [c for c in ("messages", "unmask") if c in data.column_names]
+                )
+            ]
+            processed = self._lookup(keys)
+            missed = [i for i in range(len(keys)) if i not in processed]
+            self.hits += len(processed)
+            self.misses += len(missed)
+
+            if missed:
+                missed_data = process_samples(
+                    data.select(missed), tokenizer, num_cpu_procs
+                )
+                columns = [
+                    c for c in missed_data.column_names if c not in data.column_names
+                ]
+                missed_samples = {}
+                for i, sample in zip(missed, missed_data.select_columns(columns)):
+                    processed[i] = sample
+                    missed_samples[keys[i]] = sample
+                self._store(missed_samples)
+            else:
+                columns = list(processed[0]) if processed else []
+
+            # The samples keep their original order
+            return concatenate_datasets(
+                [
+                    data,
+                    Dataset.from_dict(
+                        {
+                            column: [processed[i][column] for i in range(len(data))]
+                            for column in columns
+                        }
+                    ),
+                ],
+                axis=1,
+            )
+
     # define training-specific arguments
     skill_training_args = TrainingArgs(
         # define data-specific arguments
@@ -72,7 +269,246 @@ def data_processing_op(
         is_padding_free=True,
     )
 
-    def data_processing(train_args: TrainingArgs) -> None:
+    process_samples = getattr(dp, "process_samples", None)
+    tokenized_cache = None
+    if tokenized_cache_size_gb > 0:
+        # The legacy data processing of chat_tmpl_path tokenizes the samples in a single step with the filtering
+        if not cache_path:
+            print("Caching tokenized samples requires a cache path, skipping")
+        elif process_samples is None or skill_training_args.chat_tmpl_path:
+            print(
+                "Caching tokenized samples requires the data processing without chat_tmpl_path, skipping"
+            )
+        else:
+            tokenized_cache_dir = os.path.join(cache_path, "tokenized")
+            print(
+                f"Caching tokenized samples in {tokenized_cache_dir} (up to {tokenized_cache_size_gb}GB)"
+            )
+            tokenized_cache = TokenizedSampleCache(
+                tokenized_cache_dir,
+                tokenized_cache_size_gb * 1024**3,
+                model_path,
+                skill_training_args.chat_tmpl_path,
+            )
+            dp.process_samples = tokenized_cache.process_samples
+
+    # The processed data only holds the samples that weren't dropped, record the lengths of all of them
+    sample_lengths = []
+    if process_samples is not None and not skill_training_args.chat_tmpl_path:
+        length_process_samples = dp.process_samples
+
+        def process_samples_recording_lengths(data, tokenizer, num_cpu_procs):
+            processed = length_process_samples(data, tokenizer, num_cpu_procs)
+            sample_lengths.append(np.asarray(processed["len"], dtype=np.int64))
+            return processed
+
+        dp.process_samples = process_samples_recording_lengths
+
+    def write_token_arrays(data_output_dir):
+        """Writes the processed samples of data.jsonl as flat token arrays that can be memory-mapped with NumPy.
+
+        input_ids.bin and labels.bin hold the tokens of all the samples back to back as int32, and index.npy holds
+        the offset and the length of each sample, so that sample i is
+        np.memmap("input_ids.bin", dtype=np.int32, mode="r")[offset:offset + length] with
+        offset, length = np.load("index.npy", mmap_mode="r")[i].
+        """
+        index = []
+        num_tokens = 0
+        with (
+            open(os.path.join(data_output_dir, "data.jsonl"), encoding="utf-8") as f,
+            open(
+                os.path.join(data_output_dir, "input_ids.bin"), "wb"
+            ) as input_ids_file,
+            open(os.path.join(data_output_dir, "labels.bin"), "wb") as labels_file,
+        ):
+            for line in f:
+                if not line.strip():
+                    continue
+                sample = json.loads(line)
+                np.asarray(sample["input_ids"], dtype=np.int32).tofile(input_ids_file)
+                np.asarray(sample["labels"], dtype=np.int32).tofile(labels_file)
+                index.append((num_tokens, len(sample["input_ids"])))
+                num_tokens += len(sample["input_ids"])
+        np.save(
+            os.path.join(data_output_dir, "index.npy"),
+            np.asarray(index, dtype=np.int64).reshape(-1, 2),
+        )
+        with open(
+            os.path.join(data_output_dir, "token_arrays.json"), "w", encoding="utf-8"
+        ) as f:
+            json.dump(
+                {
+                    "dtype": "int32",
+                    "num_samples": len(index),
+                    "num_tokens": num_tokens,
+                    "files": {
+                        "input_ids": "input_ids.bin",
+                        "labels": "labels.bin",
+                        "index": "index.npy",
+                    },
+                },
+                f,
+                indent=2,
+            )
+        print(
+            f"Wrote {len(index)} samples and {num_tokens} tokens as token arrays to {data_output_dir}"
+        )
+
+    def first_fit_decreasing(lengths, capacity):
+        """Packs the samples into as few bins of capacity tokens as first-fit-decreasing finds.
+
+        The first bin with enough room is found in a segment tree of the room left in each bin, so packing takes
+        O(n log n) instead of O(n * bins). Samples longer than the capacity get a bin of their own.
+        """
+        num_leaves = 1
+        while num_leaves < len(lengths):
+            num_leaves *= 2
+        # The room left in the bins under each node, unused bins are empty
+        room = [capacity] * (2 * num_leaves)
+        bins = []
+        oversized = []
+        for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            length = lengths[i]
+            if length > capacity:
+                oversized.append([i])
+                continue
+            node = 1
+            while node < num_leaves:
+                node = 2 * node if room[2 * node] >= length else 2 * node + 1
+            leaf = node - num_leaves
+            if leaf == len(bins):
+                bins.append([])
+            bins[leaf].append(i)
+            room[node] -= length
+            while node > 1:
+                node //= 2
+                room[node] = max(room[2 * node], room[2 * node + 1])
+        return bins + oversized
+
+    def write_packing_plan(data_output_dir):
+        """Writes the packing of the samples of data.jsonl into batches of packing_max_batch_len tokens per rank.
+
+        Each step of packing_plan.json holds a bin of sample indices (line numbers in data.jsonl) for each rank.
+        The bins are packed with first-fit-decreasing and the ones with similar token counts are put in the same
+        step so that the ranks wait as little as possible for each other.
+        """
+        with open(os.path.join(data_output_dir, "data.jsonl"), encoding="utf-8") as f:
+            lengths = [json.loads(line)["len"] for line in f if line.strip()]
+        num_ranks = nproc_per_node * nnodes
+        bins = sorted(
+            first_fit_decreasing(lengths, packing_max_batch_len),
+            key=lambda b: -sum(lengths[i] for i in b),
+        )
+        steps = [bins[i : i + num_ranks] for i in range(0, len(bins), num_ranks)]
+        if steps:
+            # The ranks without a bin in the last step idle
+            steps[-1] += [[] for _ in range(num_ranks - len(steps[-1]))]
+        num_tokens = sum(lengths)
+        # Padding-free batches only waste the tokens the bins don't fill, and the idle ranks
+        efficiency = num_tokens / max(len(steps) * num_ranks * packing_max_batch_len, 1)
+        plan = {
+            "max_batch_len": packing_max_batch_len,
+            "num_ranks": num_ranks,
+            "num_samples": len(lengths),
+            "num_tokens": num_tokens,
+            "num_bins": len(bins),
+            "num_steps": len(steps),
+            "oversized_samples": sum(
+                length > packing_max_batch_len for length in lengths
+            ),
+            "efficiency": efficiency,
+            "waste_ratio": 1 - efficiency,
+            "steps": steps,
+        }
+        with open(
+            os.path.join(data_output_dir, "packing_plan.json"), "w", encoding="utf-8"
+        ) as f:
+            json.dump(plan, f)
+        print(
+            f"Packed {len(lengths)} samples into {len(steps)} steps of {num_ranks} ranks with "
+            f"{packing_max_batch_len} tokens each, {efficiency:.2%} efficiency"
+        )
+
+    def write_length_stats(train_args):
+        """Writes the token length statistics of a dataset and the max_seq_len and max_batch_len they suggest."""
+        with open(
+            os.path.join(train_args.data_output_dir, "data.jsonl"), encoding="utf-8"
+        ) as f:
+            kept_lengths = np.asarray(
+                [json.loads(line)["len"] for line in f if line.strip()], dtype=np.int64
+            )
+        num_samples = 0
+        for data_file in glob.glob(train_args.data_path):
+            with open(data_file, encoding="utf-8") as f:
+                num_samples += sum(1 for line in f if line.strip())
+        # Without the lengths of the dropped samples, only the kept ones are described
+        lengths = np.concatenate(sample_lengths) if sample_lengths else kept_lengths
+        if not len(lengths):
+            lengths = np.zeros(1, dtype=np.int64)
+
+        counts, edges = np.histogram(lengths, bins=LENGTH_HISTOGRAM_BINS)
+        percentiles = dict(
+            zip(
+                ("p50", "p90", "p95", "p99"),
+                np.percentile(lengths, [50, 90, 95, 99]).tolist(),
+            )
+        )
+        # Up to target_drop_rate of the samples are longer, rounded up to a multiple of 64 tokens
+        suggested_max_seq_len = int(
+            -(-(np.quantile(lengths, 1 - target_drop_rate) + 1) // 64) * 64
+        )
+        packable_lengths = lengths[
+            (lengths >= MIN_SEQ_LEN) & (lengths < suggested_max_seq_len)
+        ].tolist()
+        suggested_max_batch_len = suggested_max_seq_len * MAX_BATCH_LEN_MULTIPLES[-1]
+        for multiple in MAX_BATCH_LEN_MULTIPLES:
+            max_batch_len = suggested_max_seq_len * multiple
+            bins = first_fit_decreasing(packable_lengths, max_batch_len)
+            waste = 1 - sum(packable_lengths) / max(len(bins) * max_batch_len, 1)
+            if waste <= TARGET_PACKING_WASTE:
+                suggested_max_batch_len = max_batch_len
+                break
+
+        stats = {
+            "num_samples": num_samples,
+            "num_kept_samples": len(kept_lengths),
+            "num_dropped_samples": num_samples - len(kept_lengths),
+            "num_too_long_samples": int(np.sum(lengths >= train_args.max_seq_len))
+            if sample_lengths
+            else None,
+            "num_too_short_samples": int(np.sum(lengths < MIN_SEQ_LEN))
+            if sample_lengths
+            else None,
+            "max_seq_len": train_args.max_seq_len,
+            "max_batch_len": packing_max_batch_len or train_args.max_batch_len,
+            "num_tokens": int(kept_lengths.sum()),
+            "length_min": int(lengths.min()),
+            "length_mean": float(lengths.mean()),
+            "length_max": int(lengths.max()),
+            "length_percentiles": percentiles,
+            "length_histogram": {
+                "edges": edges.tolist(),
+                "counts": counts.tolist(),
+            },
+            "target_drop_rate": target_drop_rate,
+            "suggested_max_seq_len": suggested_max_seq_len,
+            "suggested_max_batch_len": suggested_max_batch_len,
+        }
+        with open(
+            os.path.join(train_args.data_output_dir, "length_stats.json"),
+            "w",
+            encoding="utf-8",
+        ) as f:
+            json.dump(stats, f, indent=2)
+        print(
+            f"{stats['num_dropped_samples']} of {num_samples} samples of {train_args.data_path} were dropped at "
+            f"max_seq_len {train_args.max_seq_len}, lengths p50 {percentiles['p50']:.0f}, p99 "
+            f"{percentiles['p99']:.0f}, max {stats['length_max']}. Suggested max_seq_len "
+            f"{suggested_max_seq_len} and max_batch_len {suggested_max_batch_len} for a "
+            f"{target_drop_rate:.1%} drop rate"
+        )
+
+    def data_processing(train_args: TrainingArgs, num_cpu_procs: int) -> None:
         # early validation logic here
         if train_args.max_batch_len < train_args.max_seq_len:
             raise ValueError(
@@ -95,11 +531,106 @@ def data_processing_op(
                 data_path=train_args.data_path,
                 max_seq_len=train_args.max_seq_len,
                 chat_tmpl_path=train_args.chat_tmpl_path,
+                num_cpu_procs=num_cpu_procs,
             )
         )
+        if tokenized_cache:
+            print(
+                f"Tokenized sample cache for {train_args.data_path}: {tokenized_cache.hits} hits, "
+                f"{tokenized_cache.misses} misses, {tokenized_cache.evictions} evictions"
+            )
+        if token_arrays:
+            write_token_arrays(train_args.data_output_dir)
+        if packing_max_batch_len > 0:
+            write_packing_plan(train_args.data_output_dir)
+        write_length_stats(train_args)
+
+    datasets = {"skills": skill_training_args, "knowledge": knowledge_training_args}
+    # The pod only uses its CPUs, share them between the datasets in proportion to their size
+    num_cpus = len(os.sched_getaffinity(0))
+    dataset_sizes = {
+        name: sum(os.path.getsize(f) for f in glob.glob(train_args.data_path)) or 1
+        for name, train_args in datasets.items()
+    }
+    num_cpu_procs = {
+        name: max(1, num_cpus * size // sum(dataset_sizes.values()))
+        for name, size in dataset_sizes.items()
+    }
 
-    data_processing(train_args=skill_training_args)
-    data_processing(train_args=knowledge_training_args)
+    def data_processing_worker(name, train_args, error_queue):
+        try:
+            data_processing(train_args=train_args, num_cpu_procs=num_cpu_procs[name])
+        except BaseException:
+            error_queue.put((name, traceback.format_exc()))
+            sys.exit(1)
+
+    # The datasets are processed in their own processes since the tokenizers and datasets libraries don't
+    # release the GIL
+    mp_context = multiprocessing.get_context("fork")
+    error_queue = mp_context.Queue()
+    workers = {}
+    for name, train_args in datasets.items():
+        print(f"Processing the {name} dataset with {num_cpu_procs[name]} processes")
+        workers[name] = mp_context.Process(
+            target=data_processing_worker,
+            args=(name, train_args, error_queue),
+            name=f"data-processing-{name}",
+        )
+        workers[name].start()
+
+    # A worker only exits once its error was read from the queue, so read it before joining the workers
+    errors = {}
+    while (
+        any(worker.is_alive() for worker in workers.values()) or not error_queue.empty()
+    ):
+        try:
+            name, error = error_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+        errors[name] = error
+    for worker in workers.values():
+        worker.join()
+    for name, worker in workers.items():
+        if worker.exitcode != 0:
+            errors.setdefault(name, f"The worker exited with code {worker.exitcode}")
+    for name, error in errors.items():
+        print(f"Processing the {name} dataset failed:\n{error}")
+    if errors:
+        raise RuntimeError(
+            f"Data processing failed for the {' and '.join(errors)} datasets"
+        )
+
+    if packing_max_batch_len > 0:
+        # The metrics can only be logged by this process
+        for name, train_args in datasets.items():
+            with open(
+                os.path.join(train_args.data_output_dir, "packing_plan.json"),
+                encoding="utf-8",
+            ) as f:
+                plan = json.load(f)
+            metrics.log_metric(
+                f"{name}_packing_efficiency", round(plan["efficiency"], 4)
+            )
+            metrics.log_metric(
+                f"{name}_packing_waste_ratio", round(plan["waste_ratio"], 4)
+            )
+            metrics.log_metric(f"{name}_packing_steps", plan["num_steps"])
+    for name, train_args in datasets.items():
+        with open(
+            os.path.join(train_args.data_output_dir, "length_stats.json"),
+            encoding="utf-8",
+        ) as f:
+            stats = json.load(f)
+        for stat in (
+            "num_samples",
+            "num_dropped_samples",
+            "length_max",
+            "suggested_max_seq_len",
+            "suggested_max_batch_len",
+        ):
+            metrics.log_metric(f"{name}_{stat}", stats[stat])
+        for percentile, value in stats["length_percentiles"].items():
+            metrics.log_metric(f"{name}_length_{percentile}", round(value, 1))
 
 
 @dsl.container_component
@@ -1,4 +1,5 @@
 from .components import (
+    create_cache_pvc_op,
     ilab_importer_op,
     model_to_pvc_op,
     pvc_to_mmlu_branch_op,
@@ -14,4 +15,5 @@ __all__ = [
     "pvc_to_mmlu_branch_op",
     "ilab_importer_op",
     "upload_model_op",
+    "create_cache_pvc_op",
 ]
@@ -1,6 +1,6 @@
 # type: ignore
 
-from typing import Optional
+from typing import NamedTuple, Optional
 
 from kfp import dsl
 from kfp.kubernetes import use_config_map_as_volume
@@ -296,6 +296,48 @@ def model_to_pvc_op(model: dsl.Input[dsl.Model], pvc_path: str = "/model"):
             shutil.copy(src, dest)
 
 
+@dsl.component(base_image=RUNTIME_GENERIC_IMAGE, install_kfp_package=False)
+def create_cache_pvc_op(pvc_name: str, storage_class_name: str, size: str) -> str:
+    from kubernetes import client, config
+    from kubernetes.client.rest import ApiException
+
+    with open(
+        "/var/run/secrets/kubernetes.io/serviceaccount/namespace", "r"
+    ) as namespace_path:
+        namespace = namespace_path.readline()
+    config.load_incluster_config()
+
+    with client.ApiClient() as api_client:
+        core_api = client.CoreV1Api(api_client)
+        try:
+            core_api.read_namespaced_persistent_volume_claim(pvc_name, namespace)
+            print(f"Reusing the existing cache PVC {pvc_name}")
+            return pvc_name
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+        print(f"Creating the cache PVC {pvc_name}")
+        pvc = client.V1PersistentVolumeClaim(
+            metadata=client.V1ObjectMeta(name=pvc_name),
+            spec=client.V1PersistentVolumeClaimSpec(
+                access_modes=["ReadWriteMany"],
+                storage_class_name=storage_class_name,
+                resources=client.V1VolumeResourceRequirements(
+                    requests={"storage": size}
+                ),
+            ),
+        )
+        try:
+            core_api.create_namespaced_persistent_volume_claim(namespace, pvc)
+        except ApiException as e:
+            # Another pipeline run created it in the meantime
+            if e.status != 409:
+                raise
+
+    return pvc_name
+
+
 @dsl.container_component
 def ilab_importer_op(repository: str, release: str, base_model: dsl.Output[dsl.Model]):
     return dsl.ContainerSpec(
@@ -308,17 +350,53 @@ def ilab_importer_op(repository: str, release: str, base_model: dsl.Output[dsl.M
 
 
 @dsl.component(base_image=RUNTIME_GENERIC_IMAGE, install_kfp_package=False)
-def test_model_connection(secret_name: str):
+def test_model_connection(
+    secret_name: str,
+    metrics: dsl.Output[dsl.Metrics],
+    probe: bool = False,
+    batch_size: int = 0,
+    num_workers: int = 0,
+) -> NamedTuple(
+    "outputs", server_ctx_size=int, batch_size=int, num_workers=int, model_family=str
+):
     import base64
+    import concurrent.futures
+    import re
     import ssl
     import sys
     import textwrap
     import time
+    from typing import NamedTuple
 
     import httpx
     from kubernetes import client, config
     from kubernetes.client.rest import ApiException
 
+    # A server_ctx_size of 0 leaves it to SDG to ask the model server
+    DEFAULT_SERVER_CTX_SIZE = 0
+    DEFAULT_MODEL_FAMILY = "mixtral"
+    # Names of the served model mapped to the prompt templates SDG accepts, checked in this order
+    MODEL_FAMILIES = {
+        "mixtral": "mixtral",
+        "mistral": "mixtral",
+        "merlinite": "merlinite",
+        "granite": "merlinite",
+    }
+    PROBE_BATCH_SIZES = [1, 4, 16, 64, 256]
+    # The range of sdg_num_workers accepted by test_sdg_params
+    PROBE_NUM_WORKERS = [2, 4, 8, 10]
+    PROBE_MAX_TOKENS = 16
+    # A larger batch size or number of workers must improve the throughput by this factor to be chosen
+    PROBE_MIN_GAIN = 1.2
+
+    outputs = NamedTuple(
+        "outputs",
+        server_ctx_size=int,
+        batch_size=int,
+        num_workers=int,
+        model_family=str,
+    )
+
     config.load_incluster_config()
 
     model_endpoint = ""
@@ -356,33 +434,137 @@ def test_model_connection(secret_name: str):
     # Use the default SSL context since it leverages OpenSSL to use the correct CA bundle.
     http_client = httpx.Client(verify=ssl.create_default_context())
 
-    # Make 3 attempts
-    for i in range(1, 3):
-        resp = http_client.post(
-            f"{model_endpoint}/chat/completions",
-            headers=request_auth,
-            json=request_body,
-        )
-        if resp.status_code != 200:
-            print(f"Model Server {model_name} is not available. Attempt {i}/3...")
-            time.sleep(5)
+    # The endpoint can list the replicas of the model server, separated by commas or whitespace
+    model_endpoints = [e.rstrip("/") for e in re.split(r"[,\s]+", model_endpoint) if e]
+    for model_endpoint in model_endpoints:
+        # Make 3 attempts
+        for i in range(1, 3):
+            resp = http_client.post(
+                f"{model_endpoint}/chat/completions",
+                headers=request_auth,
+                json=request_body,
+            )
+            if resp.status_code != 200:
+                print(
+                    f"Model Server {model_name} at {model_endpoint} is not available. Attempt {i}/3..."
+                )
+                time.sleep(5)
+            else:
+                print(
+                    textwrap.dedent(f"""\
+                ################### INFO #######################
+                # Model Server {model_name} is up and running. #
+                ################################################\
+                """)
+                )
+                break
         else:
             print(
                 textwrap.dedent(f"""\
-            ################### INFO #######################
-            # Model Server {model_name} is up and running. #
-            ################################################\
+            ############################################ ERROR ####################################################
+            # Model Server {model_name} is unavailable. Ensure the model is up and it is ready to serve requests. #
+            #######################################################################################################\
             """)
             )
-            return
+            sys.exit(1)
+
+    if not probe:
+        return outputs(
+            DEFAULT_SERVER_CTX_SIZE, batch_size, num_workers, DEFAULT_MODEL_FAMILY
+        )
+
+    # Size SDG for the teacher model server, the first replica is probed
+    model_endpoint = model_endpoints[0]
+    # Large batches of completions can take a while
+    http_client.timeout = httpx.Timeout(600.0, connect=10.0)
+    server_ctx_size = DEFAULT_SERVER_CTX_SIZE
+    model_family = DEFAULT_MODEL_FAMILY
+    resp = http_client.get(f"{model_endpoint}/models", headers=request_auth)
+    if resp.status_code == 200:
+        for served_model in resp.json().get("data", []):
+            if served_model.get("id") != model_name:
+                continue
+            # vLLM reports the context window and the model the served name refers to
+            server_ctx_size = served_model.get("max_model_len") or server_ctx_size
+            served_model_path = (served_model.get("root") or model_name).lower()
+            model_family = next(
+                (
+                    prompt_family
+                    for family, prompt_family in MODEL_FAMILIES.items()
+                    if family in served_model_path
+                ),
+                model_family,
+            )
+    else:
+        print(f"Listing the models of {model_endpoint} failed: {resp.status_code}")
+
+    def send_completions(num_prompts):
+        # SDG batches its requests to the teacher model as a list of prompts per completions request
+        resp = http_client.post(
+            f"{model_endpoint}/completions",
+            headers=request_auth,
+            json={
+                "model": model_name,
+                "prompt": ["tell me a funny joke."] * num_prompts,
+                "max_tokens": PROBE_MAX_TOKENS,
+                "temperature": 0,
+            },
+        )
+        resp.raise_for_status()
+
+    def measure_throughput(probe_batch_size, probe_num_workers):
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(probe_num_workers) as executor:
+            for future in [
+                executor.submit(send_completions, probe_batch_size)
+                for _ in range(probe_num_workers)
+            ]:
+                future.result()
+        elapsed = time.monotonic() - start
+        throughput = probe_batch_size * probe_num_workers / elapsed
+        print(
+            f"Batch size {probe_batch_size} with {probe_num_workers} workers: {elapsed:.2f}s, "
+            f"{throughput:.2f} completions/s"
+        )
+        return elapsed, throughput
+
+    try:
+        # The first request also loads anything the model server loads lazily
+        send_completions(1)
+        single_latency, best_throughput = measure_throughput(1, 1)
+        probed_batch_size = 1
+        for probe_batch_size in PROBE_BATCH_SIZES[1:]:
+            _, throughput = measure_throughput(probe_batch_size, 1)
+            if throughput < best_throughput * PROBE_MIN_GAIN:
+                break
+            probed_batch_size, best_throughput = probe_batch_size, throughput
+        probed_num_workers = 1
+        for probe_num_workers in PROBE_NUM_WORKERS:
+            _, throughput = measure_throughput(probed_batch_size, probe_num_workers)
+            if throughput < best_throughput * PROBE_MIN_GAIN:
+                break
+            probed_num_workers, best_throughput = probe_num_workers, throughput
+        batch_size = probed_batch_size
+        # The requests are spread over the replicas
+        num_workers = max(probed_num_workers, PROBE_NUM_WORKERS[0]) * len(
+            model_endpoints
+        )
+        metrics.log_metric("teacher_latency", round(single_latency, 4))
+        metrics.log_metric("teacher_completions_per_second", round(best_throughput, 2))
+    except httpx.HTTPError as e:
+        print(
+            f"Probing {model_name} failed, keeping the configured batch size and number of workers: {e}"
+        )
+
     print(
-        textwrap.dedent(f"""\
-    ############################################ ERROR ####################################################
-    # Model Server {model_name} is unavailable. Ensure the model is up and it is ready to serve requests. #
-    #######################################################################################################\
-    """)
+        f"Model {model_name}: context window {server_ctx_size or 'unknown'}, model family {model_family}, "
+        f"batch size {batch_size}, {num_workers} workers"
     )
-    sys.exit(1)
+    metrics.log_metric("teacher_server_ctx_size", server_ctx_size)
+    metrics.log_metric("teacher_batch_size", batch_size)
+    metrics.log_metric("teacher_num_workers", num_workers)
+
+    return outputs(server_ctx_size, batch_size, num_workers, model_family)
 
 
 # sdg_num_workers directly maps to num_cpus in the SDG phase of InstructLab